@@ -0,0 +1,71 @@
+'''
+Time to load a saved amara3.uxml.binary tree, against reparsing its document
+
+python bench/treeload.py [number of records]
+
+Compares binary.load with tree.parse of the MicroXML, amara3.uxml.xml.treebuilder of the same
+document as XML, and pickle, for a document of many small records.
+Also times opening the saved file with binary.map_file and reading one record through it
+'''
+
+import io
+import os
+import sys
+import time
+import pickle
+import tempfile
+
+from amara3.uxml import tree, binary
+from amara3.uxml import xml as uxml_xml
+
+
+def make_doc(count):
+    #Typical record data: attributes on some elements, leaf elements, some empty
+    return '<db>' + ''.join(
+        '<record id="{0}"><name>Name {0}</name><flag></flag><value unit="m">{1}</value><note></note></record>'.format(i, i*7)
+        for i in range(count)) + '</db>'
+
+
+def best(func, repeat=3):
+    #Best of a few runs, in seconds
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    doc = make_doc(count)
+    root = tree.parse(doc)
+    fp = io.BytesIO()
+    binary.dump(root, fp)
+    saved = fp.getvalue()
+    pickled = pickle.dumps(root, pickle.HIGHEST_PROTOCOL)
+    assert binary.load(io.BytesIO(saved)).xml_encode() == doc
+
+    load_time = best(lambda: binary.load(io.BytesIO(saved)))
+    print('{0} records, {1} bytes of MicroXML, {2} bytes saved'.format(count, len(doc.encode('utf-8')), len(saved)))
+    print('binary.load: {0:.3f}s'.format(load_time))
+    for label, func in (
+            ('tree.parse', lambda: tree.parse(doc)),
+            ('xml.treebuilder', lambda: uxml_xml.treebuilder().parse(doc)),
+            ('pickle.loads', lambda: pickle.loads(pickled)),
+            ):
+        elapsed = best(func)
+        print('{0}: {1:.3f}s, {2:.1f} times binary.load'.format(label, elapsed, elapsed / load_time))
+    print('binary.dump: {0:.3f}s'.format(best(lambda: binary.dump(root, io.BytesIO()))))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'doc.uxb')
+        with open(path, 'wb') as fp:
+            fp.write(saved)
+        start = time.perf_counter()
+        mapped = binary.map_file(path)
+        opened = time.perf_counter() - start
+        record = mapped.xml_children[count // 2]
+        record.xml_encode()
+        print('binary.map_file: opened in {0:.6f}s, middle record read in {1:.3f}s'.format(opened, time.perf_counter() - start - opened))
+        del mapped, record
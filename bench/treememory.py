@@ -0,0 +1,85 @@
+'''
+Memory use of amara3.uxml.tree nodes, in bytes per node, for a document of many small records
+
+python bench/treememory.py [number of records]
+
+Also gives the same for the document in an amara3.uxml.columnar store
+
+Counts every object belonging to the tree once: the nodes themselves, any instance dicts,
+weak refs to parents, attribute dicts and children lists, and the strings they hold
+'''
+
+import sys
+import time
+
+from amara3.uxml import tree, columnar
+
+
+def make_doc(count):
+    #Typical record data: attributes on some elements, leaf elements, some empty
+    return '<db>' + ''.join(
+        '<record id="{0}"><name>Name {0}</name><flag></flag><value unit="m">{1}</value><note></note></record>'.format(i, i*7)
+        for i in range(count)) + '</db>'
+
+
+def tree_size(root):
+    '''
+    Return (number of nodes, total bytes) of the tree at root
+    '''
+    seen = set()
+    def size(obj):
+        if id(obj) in seen: return 0
+        seen.add(id(obj))
+        return sys.getsizeof(obj)
+
+    nodes = total = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        total += size(node)
+        #Weak refs to the parent, shared by its children
+        if node._xml_parent is not None:
+            total += size(node._xml_parent)
+        d = getattr(node, '__dict__', None)
+        if d is not None:
+            total += size(d)
+            total += sum(size(v) for v in d.values() if isinstance(v, str))
+        if isinstance(node, tree.element):
+            total += size(node.xml_name)
+            attrs = node.xml_attributes
+            total += size(attrs)
+            total += sum(size(k) + size(v) for k, v in attrs.items())
+            #Not via xml_children, which would create a list just to look at it
+            children = node._xml_children
+            if children is not None:
+                total += size(children)
+                stack.extend(children)
+    return nodes, total
+
+
+def store_size(st):
+    '''
+    Return (number of nodes, total bytes) of a columnar store
+    '''
+    total = sum(sys.getsizeof(a) for a in (st.name, st.parent, st.end, st.text_offset, st.attr_index, st.attr_name, st.attr_offset))
+    total += sys.getsizeof(st.text) + sys.getsizeof(st.attr_text) + sum(sys.getsizeof(n) for n in st.names)
+    return len(st), total
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    doc = make_doc(count)
+    start = time.perf_counter()
+    root = tree.parse(doc)
+    elapsed = time.perf_counter() - start
+    nodes, total = tree_size(root)
+    print('tree: {0} nodes, parsed in {1:.2f}s, {2:.1f} MiB, {3:.1f} bytes per node'.format(
+        nodes, elapsed, total / (1 << 20), total / nodes))
+    del root
+    start = time.perf_counter()
+    root = columnar.parse(doc)
+    elapsed = time.perf_counter() - start
+    nodes, total = store_size(root._store)
+    print('columnar: {0} nodes, parsed in {1:.2f}s, {2:.1f} MiB, {3:.1f} bytes per node'.format(
+        nodes, elapsed, total / (1 << 20), total / nodes))
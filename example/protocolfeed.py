@@ -17,10 +17,9 @@ for ev in parsefrags(docfragments):
     print (ev)
 
 
-from amara3.util import coroutine
 from amara3.uxml.parser import parser, event
 
-@coroutine
+#No need to prime the handler. The parser does that
 def handler():
     while True:
         ev = yield
@@ -0,0 +1,99 @@
+# -----------------------------------------------------------------------------
+# amara3.uxml.aio
+#
+# asyncio front end for the MicroXML parser
+#
+# -----------------------------------------------------------------------------
+
+'''
+Parse MicroXML as it arrives from asyncio streams, so that one event loop can
+parse many concurrent documents, e.g. from network connections, without threads
+
+>>> import asyncio
+>>> from amara3.uxml import aio
+>>> async def show_names(host, port):
+...     reader, writer = await asyncio.open_connection(host, port)
+...     async for elem in aio.itersubtrees(reader, ('feed', 'entry')):
+...         print(elem.xml_attributes.get('id'))
+'''
+
+from amara3.uxml import treeiter
+from amara3.uxml.parser import feeder
+
+
+async def _chunks(source, chunksize):
+    '''
+    Yield the chunks of input from an asyncio.StreamReader, or anything else
+    with an awaitable read(n) method, or from an async iterable of fragments
+    '''
+    read = getattr(source, 'read', None)
+    if read is not None:
+        while True:
+            chunk = await read(chunksize)
+            if not chunk: break
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+async def iterparse(source, encoding=None, chunksize=65536, lazy=False, on_checkpoint=None, resume=None, multidoc=False):
+    '''
+    Async iterator over the MicroXML events parsed from source, yielded as each chunk is read,
+    as with parser.iterparse, with which it shares parser.feeder
+
+    source - asyncio.StreamReader (or anything else with an awaitable read(n) method),
+        or async iterable of fragments, str or bytes
+    encoding - encoding of bytes input. If None, sniffed from the first few bytes
+    chunksize - number of bytes (or characters) read at a time from a reader
+    lazy - if True, text and attribute values are rawtext objects, decoded on access (see parser.parser)
+    on_checkpoint - optional function called with each new checkpoint (see parser.parser),
+        once every event before it has been yielded
+    resume - checkpoint from an earlier parse from which to carry on, in which case
+        source should start from the checkpoint's offset (or byte_offset for bytes)
+    multidoc - if True, source is a stream of any number of documents, e.g. messages on a
+        long-lived connection, each followed by an (end_document,) event (see parser.parser)
+    '''
+    feed = feeder(encoding=encoding, lazy=lazy, on_checkpoint=on_checkpoint, resume=resume, multidoc=multidoc)
+    try:
+        async for chunk in _chunks(source, chunksize):
+            for ev in feed.send(chunk):
+                yield ev
+            feed.checkpoint()
+        for ev in feed.send('', True): #Wrap it up
+            yield ev
+        feed.checkpoint()
+    finally:
+        feed.close()
+
+
+async def itersubtrees(source, pattern, encoding=None, chunksize=65536, multidoc=False):
+    '''
+    Async iterator over the element subtrees matching pattern, as with treeiter.sender,
+    each yielded once complete
+
+    source - asyncio.StreamReader (or anything else with an awaitable read(n) method),
+        or async iterable of fragments, str or bytes
+    pattern - tuple of element names, or the special wildcards '*' or '**' (see treeiter.sender)
+    encoding - encoding of bytes input. If None, sniffed from the first few bytes
+    chunksize - number of bytes (or characters) read at a time from a reader
+    multidoc - if True, source is a stream of any number of documents, with the pattern
+        matched against each in turn
+    '''
+    built = []
+    def sink():
+        while True:
+            built.append((yield))
+
+    p = treeiter.sender(pattern, sink()).parser(encoding=encoding, multidoc=multidoc)
+    try:
+        async for chunk in _chunks(source, chunksize):
+            p.send((chunk, False))
+            for elem in built:
+                yield elem
+            built.clear()
+        p.send(('', True)) #Wrap it up
+        for elem in built:
+            yield elem
+    finally:
+        p.close()
@@ -0,0 +1,459 @@
+# -----------------------------------------------------------------------------
+# amara3.uxml.binary
+#
+# Compact binary serialization of MicroXML trees
+#
+# -----------------------------------------------------------------------------
+
+'''
+Save a tree in a compact binary form which loads several times faster than
+reparsing the MicroXML or XML it came from
+
+>>> import io
+>>> from amara3.uxml import tree, binary
+>>> fp = io.BytesIO()
+>>> binary.dump(tree.parse('<a x="1">2<b>3</b></a>'), fp)
+>>> fp.seek(0)
+0
+>>> binary.load(fp).xml_encode()
+'<a x="1">2<b>3</b></a>'
+
+The format, all integers being little-endian:
+
+header - MAGIC, then the sizes in bytes of the three sections following, as unsigned 64-bit integers
+names - number of names, then each element or attribute name as varint length and UTF-8 bytes.
+    Names are referred to by their position in this table
+structure - one record per node, in document order:
+    text - varint (UTF-8 length of the text << 1) | 1
+    element - varint (name id << 1), varint number of attributes, then for each attribute
+        varint name id, varint UTF-8 length of the value and the value bytes,
+        then varint UTF-8 length of the element's string value and varint size of the records of its descendants
+text - UTF-8 of all text nodes, in document order
+
+Varints are unsigned, seven bits to a byte, least significant first, with the high bit set
+on all but the last byte. The text of an element is a contiguous range of the text section,
+and its descendants a contiguous range of the structure, whose sizes its record gives,
+so an element's subtree can be skipped, or its string value read, without decoding its descendants.
+
+Only names, attributes and text are saved, so trees are loaded as tree.element and tree.text,
+whatever classes they were built with.
+
+A saved file can also be used in place, without loading it, through map_file. Its nodes are then
+proxies, subclasses of tree.element and tree.text like those of amara3.uxml.columnar, decoded from
+the memory mapped file as they are visited, so code written for amara3.uxml.tree, including uxpath
+queries, works unchanged. Proxies for the same element compare equal. Such documents are read-only.
+'''
+
+import gc
+import mmap
+import struct
+import weakref
+
+from amara3.uxml import tree
+
+MAGIC = b'UXB\x01'
+
+HEADER = struct.Struct('<4sQQQ')
+
+
+def _varint(value):
+    #Unsigned LEB128
+    if value < 0x80: return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data, pos):
+    '''
+    Decode the varint at pos in data, returning (value, position after it)
+    '''
+    byte = data[pos]
+    pos += 1
+    if byte < 0x80: return byte, pos
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80: return value, pos
+        shift += 7
+
+
+def dump(elem, fp):
+    '''
+    Write the tree at elem to a binary file object
+
+    elem - element at the top of the tree to save. Its parent, if any, is not saved
+    fp - file object opened for writing bytes
+    '''
+    name_ids = {}
+    def name_id(name):
+        nid = name_ids.get(name)
+        if nid is None:
+            nid = name_ids[name] = len(name_ids)
+        return nid
+
+    #Element records up to their sizes, and encoded text, for each node in document order, with the position of its parent
+    heads = []
+    texts = []
+    parents = []
+    stack = [(elem, -1)]
+    while stack:
+        node, parent = stack.pop()
+        parents.append(parent)
+        if isinstance(node, tree.element):
+            head = [_varint(name_id(node.xml_name) << 1), _varint(len(node.xml_attributes))]
+            for aname, aval in node.xml_attributes.items():
+                aval = aval.encode('utf-8')
+                head.extend((_varint(name_id(aname)), _varint(len(aval)), aval))
+            heads.append(b''.join(head))
+            texts.append(None)
+            children = node._xml_children
+            if children:
+                me = len(heads) - 1
+                stack.extend( (child, me) for child in reversed(children) )
+        else:
+            heads.append(None)
+            texts.append(str(node).encode('utf-8'))
+
+    #Working back from the last node, so that each element's descendants are done before it
+    count = len(heads)
+    text_sizes = [0] * count
+    content_sizes = [0] * count
+    records = [None] * count
+    for i in range(count - 1, -1, -1):
+        head = heads[i]
+        if head is None:
+            text_size = len(texts[i])
+            record = records[i] = _varint((text_size << 1) | 1)
+            size = len(record)
+        else:
+            text_size = text_sizes[i]
+            record = records[i] = head + _varint(text_size) + _varint(content_sizes[i])
+            size = len(record) + content_sizes[i]
+        parent = parents[i]
+        if parent != -1:
+            text_sizes[parent] += text_size
+            content_sizes[parent] += size
+
+    names = [_varint(len(name_ids))]
+    for name in name_ids:
+        name = name.encode('utf-8')
+        names.extend((_varint(len(name)), name))
+    names = b''.join(names)
+    structure = b''.join(records)
+    text = b''.join( t for t in texts if t is not None )
+    fp.write(HEADER.pack(MAGIC, len(names), len(structure), len(text)))
+    fp.write(names)
+    fp.write(structure)
+    fp.write(text)
+
+
+def _sections(data):
+    '''
+    Check the header of saved tree data, returning the offsets of its names, structure and text sections, and its end
+    '''
+    if len(data) < HEADER.size:
+        raise ValueError('Not a saved amara3.uxml tree: too short')
+    magic, names_size, structure_size, text_size = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a saved amara3.uxml tree: bad magic number {0!r}'.format(magic))
+    names_start = HEADER.size
+    structure_start = names_start + names_size
+    text_start = structure_start + structure_size
+    end = text_start + text_size
+    if len(data) < end:
+        raise ValueError('Saved amara3.uxml tree is truncated')
+    return names_start, structure_start, text_start, end
+
+
+def _read_names(data, pos):
+    count, pos = _read_varint(data, pos)
+    names = []
+    for i in range(count):
+        size, pos = _read_varint(data, pos)
+        names.append(str(data[pos:pos+size], 'utf-8'))
+        pos += size
+    return names
+
+
+def load(fp):
+    '''
+    Read a tree written by dump from a binary file object, returning its top element
+    '''
+    data = fp.read()
+    #Cyclic garbage collection would otherwise run over and over as the nodes are created, though none can be garbage
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _load(data)
+    finally:
+        if gc_was_enabled: gc.enable()
+
+
+def _load(data):
+    names_start, pos, text_start, end = _sections(data)
+    names = _read_names(data, names_start)
+    structure_end = text_start
+    #All the text at once. If it's ASCII, byte offsets serve for the str as well, and no text node need be decoded on its own
+    text_bytes = data[text_start:end]
+    text_str = str(text_bytes, 'utf-8')
+    if len(text_str) == len(text_bytes): text_bytes = text_str
+    tpos = 0
+
+    new_element, new_text = tree.element.__new__, str.__new__
+    element_class, text_class = tree.element, tree.text
+    empty = tree.EMPTY_ATTRIBUTES
+    ref = weakref.ref
+    #Open elements as (children list, weak ref to the element, end of its descendants' records)
+    top = None
+    children = parent_ref = None
+    children_end = structure_end
+    stack = []
+    while pos < structure_end:
+        while pos >= children_end:
+            children, parent_ref, children_end = stack.pop()
+        code = data[pos]
+        pos += 1
+        if code >= 0x80:
+            code, pos = _read_varint(data, pos - 1)
+        if code & 1:
+            size = code >> 1
+            value = text_bytes[tpos:tpos+size]
+            tpos += size
+            node = new_text(text_class, value if value.__class__ is str else str(value, 'utf-8'))
+            node._xml_parent = parent_ref
+            children.append(node)
+            continue
+        elem = new_element(element_class)
+        elem.xml_name = names[code >> 1]
+        count = data[pos]
+        pos += 1
+        if count >= 0x80:
+            count, pos = _read_varint(data, pos - 1)
+        if count:
+            attrs = {}
+            for i in range(count):
+                aname = data[pos]
+                size = data[pos+1]
+                pos += 2
+                if aname >= 0x80 or size >= 0x80:
+                    aname, pos = _read_varint(data, pos - 2)
+                    size, pos = _read_varint(data, pos)
+                attrs[names[aname]] = str(data[pos:pos+size], 'utf-8')
+                pos += size
+            elem.xml_attributes = attrs
+        else:
+            elem.xml_attributes = empty
+        elem._xml_value_cache = None
+        #The length of the string value isn't needed to build the tree. Skip its bytes
+        while data[pos] >= 0x80: pos += 1
+        content_size = data[pos+1]
+        pos += 2
+        if content_size >= 0x80:
+            content_size, pos = _read_varint(data, pos - 1)
+        elem._xml_parent = parent_ref
+        if top is None:
+            top = elem
+        else:
+            children.append(elem)
+        if content_size:
+            stack.append((children, parent_ref, children_end))
+            children = elem._xml_children = []
+            parent_ref = ref(elem)
+            children_end = pos + content_size
+        else:
+            elem._xml_children = None
+    return top
+
+
+class document(object):
+    '''
+    A saved tree, read in place from a buffer such as a memory mapping, through proxy nodes
+    which decode their records only when visited. Only the header and the names table are read up front
+
+    data - the saved tree, as bytes, mmap or other buffer supporting indexing and slicing
+    '''
+    def __init__(self, data):
+        self.data = data
+        names_start, self._structure_start, self._text_start, end = _sections(data)
+        self.names = _read_names(data, names_start)
+
+    @property
+    def root(self):
+        '''
+        Proxy for the top element, or None for an empty tree
+        '''
+        if self._structure_start == self._text_start: return None
+        return element(self, self._structure_start, self._text_start, None)
+
+    def close(self):
+        '''
+        Close the underlying memory mapping, if any. Proxies can no longer be used after
+        '''
+        if hasattr(self.data, 'close'): self.data.close()
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError('Memory mapped documents are read-only')
+
+
+class element(tree.element):
+    '''
+    Proxy for an element record in a document
+
+    The record is decoded when the proxy is made, except for attribute values.
+    Each proxy holds its parent's proxy, so ancestors stay available
+    '''
+    __slots__ = ('_doc', '_pos', '_parent', '_name_id', '_attrs_pos', '_attr_count', '_text_pos', '_text_size', '_content_pos', '_content_end')
+
+    def __init__(self, doc, pos, text_pos, parent):
+        self._doc = doc
+        self._pos = pos
+        self._text_pos = text_pos
+        self._parent = parent
+        data = doc.data
+        #Most varints are one byte, so check for those before decoding in full
+        code, count = data[pos], data[pos+1]
+        if code < 0x80 and count < 0x80:
+            pos += 2
+        else:
+            code, pos = _read_varint(data, pos)
+            count, pos = _read_varint(data, pos)
+        self._name_id = code >> 1
+        self._attr_count = count
+        self._attrs_pos = pos
+        for i in range(count):
+            pos = _read_varint(data, pos)[1]
+            size, pos = _read_varint(data, pos)
+            pos += size
+        text_size, content_size = data[pos], data[pos+1]
+        if text_size < 0x80 and content_size < 0x80:
+            pos += 2
+        else:
+            text_size, pos = _read_varint(data, pos)
+            content_size, pos = _read_varint(data, pos)
+        self._text_size = text_size
+        self._content_pos = pos
+        self._content_end = pos + content_size
+
+    @property
+    def xml_name(self):
+        return self._doc.names[self._name_id]
+
+    @property
+    def xml_attributes(self):
+        if not self._attr_count: return tree.EMPTY_ATTRIBUTES
+        data, names = self._doc.data, self._doc.names
+        attrs = {}
+        pos = self._attrs_pos
+        for i in range(self._attr_count):
+            aname, pos = _read_varint(data, pos)
+            size, pos = _read_varint(data, pos)
+            attrs[names[aname]] = str(data[pos:pos+size], 'utf-8')
+            pos += size
+        return attrs
+
+    @property
+    def _xml_children(self):
+        doc = self._doc
+        data = doc.data
+        children = []
+        pos, end = self._content_pos, self._content_end
+        text_pos = self._text_pos
+        while pos < end:
+            code = data[pos]
+            if code & 1:
+                #Text record, whose size varint is the whole record
+                size, next_pos = _read_varint(data, pos)
+                size >>= 1
+                children.append(text(doc, pos, text_pos, size, self))
+                text_pos += size
+                pos = next_pos
+            else:
+                child = element(doc, pos, text_pos, self)
+                children.append(child)
+                text_pos += child._text_size
+                pos = child._content_end
+        return children
+
+    @property
+    def xml_children(self):
+        return self._xml_children
+
+    @property
+    def xml_parent(self):
+        return self._parent
+
+    @property
+    def xml_value(self):
+        return str(self._doc.data[self._text_pos:self._text_pos+self._text_size], 'utf-8')
+
+    #Record positions are in document order, so nothing need be labeled, e.g. by uxpath
+    @property
+    def _docorder(self):
+        return self._pos
+
+    @_docorder.setter
+    def _docorder(self, value):
+        pass
+
+    xml_append = xml_insert = xml_remove = _read_only
+
+    def __eq__(self, other):
+        return isinstance(other, element) and other._doc is self._doc and other._pos == self._pos
+
+    def __hash__(self):
+        return hash((id(self._doc), self._pos))
+
+    def __reduce__(self):
+        #Pickles as a plain tree
+        return (tree._restore_element, (tree.element, self.xml_name, dict(self.xml_attributes), self._xml_children, None))
+
+
+class text(tree.text):
+    '''
+    Proxy for a text record in a document
+    '''
+    def __new__(cls, doc, pos, text_pos, size, parent):
+        self = str.__new__(cls, str(doc.data[text_pos:text_pos+size], 'utf-8'))
+        self._doc = doc
+        self._pos = pos
+        self._parent = parent
+        return self
+
+    def __init__(self, doc, pos, text_pos, size, parent):
+        pass
+
+    @property
+    def xml_parent(self):
+        return self._parent
+
+    @property
+    def _docorder(self):
+        return self._pos
+
+    @_docorder.setter
+    def _docorder(self, value):
+        pass
+
+    def __reduce__(self):
+        return (tree._restore_text, (tree.text, str(self), None))
+
+
+def map_file(path):
+    '''
+    Open a file written by dump through a read-only memory mapping, returning the proxy for its top element.
+    Opening takes the same time whatever the size of the file, and memory is only used for the nodes visited.
+    The mapping is closed once no proxies for the document remain
+
+    path - file system path of the saved tree
+    '''
+    with open(path, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return document(mm).root
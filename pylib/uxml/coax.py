@@ -7,6 +7,7 @@
 
 #See also: http://www.w3.org/community/microxml/wiki/MicroLarkApi
 
+from amara3.util import coroutine
 from amara3.uxml import lex
 
 #Define the events
@@ -14,14 +15,105 @@ START_ELEMENT = 1
 END_ELEMENT = 2
 TEXT = 3
 
+#Values of the predefined entities, by token type
+ENTITIES = {
+    'AMP_ENT': '&',
+    'LT_ENT': '<',
+    'GT_ENT': '>',
+    'APOS_ENT': '\'',
+    'QUOT_ENT': '"',
+}
 
-def run(s):
+
+def parse(ux, sink):
+    '''
+    Scan MicroXML text ux, sending events to the sink coroutine:
+    (START_ELEMENT, name, attrs), (TEXT, text) and (END_ELEMENT, name),
+    where attrs is a dict of the attributes in document order
+
+    Comments are dropped, and text on either side of a comment sent as one event.
+    Well-formedness is not checked, e.g. that end tags match start tags
+    '''
+    text = []
+    attrs = None #Attributes of a start tag being scanned, or None in content
+    for tok in lex.run(ux):
+        ttype = tok.type
+        if attrs is None:
+            if ttype == 'CHARDATA' or ttype == 'GT':
+                text.append(tok.value)
+            elif ttype in ENTITIES:
+                text.append(ENTITIES[ttype])
+            elif ttype == 'NUM_ENT':
+                text.append(chr(int(tok.value, 16)))
+            elif ttype == 'STARTTAG':
+                if text:
+                    sink.send((TEXT, ''.join(text)))
+                    text = []
+                name, attrs = tok.value, {}
+                attrname = None
+            elif ttype == 'ENDTAG':
+                if text:
+                    sink.send((TEXT, ''.join(text)))
+                    text = []
+                sink.send((END_ELEMENT, tok.value))
+        #Within a start tag
+        elif ttype == 'NAME':
+            attrname = tok.value
+        elif ttype == 'SGL_QUOTE' or ttype == 'DBL_QUOTE':
+            #Closing quote
+            if text is None:
+                attrs[attrname] = ''.join(val)
+                text = []
+            else:
+                text, val = None, []
+        elif ttype == 'CHARDATA':
+            val.append(tok.value)
+        elif ttype in ENTITIES:
+            val.append(ENTITIES[ttype])
+        elif ttype == 'NUM_ENT':
+            val.append(chr(int(tok.value, 16)))
+        elif ttype == 'GT':
+            sink.send((START_ELEMENT, name, attrs))
+            attrs = None
+        elif ttype == 'EMPTY_GT':
+            sink.send((START_ELEMENT, name, attrs))
+            sink.send((END_ELEMENT, name))
+            attrs = None
+    if text:
+        sink.send((TEXT, ''.join(text)))
+    return
+
+
+@coroutine
+def _builder(result):
+    #Build a tree from the events sent by parse, putting the document element in result
+    from amara3.uxml.tree import element, text
     parent = None
-    for tok in lex.run(s):
-        if tok.type in TOKEN_HANDLERS:
-            parent = TOKEN_HANDLERS[tok.type](tok, parent)
-        #yield tok
-    return parent
+    while True:
+        ev = yield
+        if ev[0] == START_ELEMENT:
+            new_element = element(ev[1], ev[2] or None, parent)
+            if parent is None:
+                result.append(new_element)
+            else:
+                parent.xml_children.append(new_element)
+            parent = new_element
+        elif ev[0] == TEXT:
+            if parent is not None:
+                parent.xml_children.append(text(ev[1], parent))
+        elif ev[0] == END_ELEMENT:
+            if parent is not None:
+                parent = parent.xml_parent
+
+
+def run(s):
+    '''
+    Scan MicroXML text s into an amara3.uxml.tree, returning its root element,
+    or None if there is no element
+    '''
+    result = []
+    parse(s, _builder(result))
+    return result[0] if result else None
 
 
 if __name__ == '__main__':
@@ -32,10 +124,6 @@ if __name__ == '__main__':
     print(root.xml_encode())
 
 
-def parse(ux, sink):
-    return
-
-
 '''
 class element(object):
     def __init__(self, name, attrmap=None, children=None, ancestor_stack=None):
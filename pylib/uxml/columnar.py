@@ -0,0 +1,289 @@
+# -----------------------------------------------------------------------------
+# amara3.uxml.columnar
+#
+# Read-only MicroXML documents held in parallel arrays
+#
+# -----------------------------------------------------------------------------
+
+'''
+A document is stored as a few parallel arrays, with one entry per node in
+document order, plus one string holding all its text, rather than as a Python
+object per node. That takes a small fraction of the memory of amara3.uxml.tree,
+and scans of the whole document run through contiguous memory.
+
+Nodes are presented through proxy objects, subclasses of tree.element and
+tree.text created as they are visited, so code written for amara3.uxml.tree,
+including uxpath queries, works unchanged. Proxies for the same element
+compare equal. The documents are read-only.
+
+>>> from amara3.uxml import columnar
+>>> root = columnar.parse('<a>1<b x="y">2</b>3</a>')
+>>> [ e.xml_value for e in root.xml_xpath('a/b') ]
+['2']
+>>> root.xml_value
+'123'
+'''
+
+from array import array
+
+from amara3.uxml import tree
+from amara3.uxml.parser import parser, mapped_chunks, START_ELEMENT, END_ELEMENT, CHARACTERS
+
+#Name id marking text nodes
+TEXT_NODE = -1
+
+
+class store(object):
+    '''
+    A whole document in arrays, indexed by the position of each node in document order
+
+    names - element names, by name id
+    name - name id of each node, or TEXT_NODE
+    parent - index of each node's parent, or -1 for the document element
+    end - index just past each node's last descendant, so that the descendants of node i are i+1 to end[i]-1
+    text_offset - offset in text of each node's text, with one more entry for the end of the text.
+        Elements have no text of their own, so an element's string value is text[text_offset[i]:text_offset[end[i]]]
+    attr_index - index of each node's first attribute in the attribute arrays, with one more entry for the end
+    attr_name - name id of each attribute
+    attr_offset - offset in attr_text of each attribute's value, with one more entry for the end
+    '''
+    def __init__(self):
+        self.names = []
+        self._name_ids = {}
+        self.name = array('i')
+        self.parent = array('i')
+        self.end = array('i')
+        self.text_offset = array('q')
+        self.attr_index = array('i')
+        self.attr_name = array('i')
+        self.attr_offset = array('q', [0])
+        self.text = ''
+        self.attr_text = ''
+        self._text_bits = []
+        self._attr_bits = []
+
+    def _name_id(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def _handler(self):
+        name, parent, end, text_offset = self.name, self.parent, self.end, self.text_offset
+        attr_index, attr_name, attr_offset = self.attr_index, self.attr_name, self.attr_offset
+        text_bits, attr_bits = self._text_bits, self._attr_bits
+        name_id = self._name_id
+        open_elements = []
+        text_len = attr_len = 0
+        last_was_text = False
+        while True:
+            evs = yield
+            #A list is a batch of events from a parser in batch mode. Otherwise it's a single event
+            if not isinstance(evs, list): evs = (evs,)
+            for ev in evs:
+                if ev[0] == START_ELEMENT:
+                    open_elements.append(len(name))
+                    parent.append(open_elements[-2] if len(open_elements) > 1 else -1)
+                    name.append(name_id(ev[1]))
+                    end.append(0) #Set at the end tag
+                    text_offset.append(text_len)
+                    attr_index.append(len(attr_name))
+                    for aname, aval in ev[2].items():
+                        attr_name.append(name_id(aname))
+                        attr_bits.append(aval)
+                        attr_len += len(aval)
+                        attr_offset.append(attr_len)
+                    last_was_text = False
+                elif ev[0] == CHARACTERS:
+                    #Text outside the document element is dropped, as with tree.treebuilder
+                    if not open_elements or not ev[1]: continue
+                    #Adjacent text, e.g. split across fragments, makes one node
+                    if not last_was_text:
+                        parent.append(open_elements[-1])
+                        name.append(TEXT_NODE)
+                        end.append(len(name))
+                        text_offset.append(text_len)
+                        attr_index.append(len(attr_name))
+                    text_bits.append(ev[1])
+                    text_len += len(ev[1])
+                    last_was_text = True
+                elif ev[0] == END_ELEMENT:
+                    end[open_elements.pop()] = len(name)
+                    last_was_text = False
+
+    def _finish(self):
+        self.text = ''.join(self._text_bits)
+        self.text_offset.append(len(self.text))
+        self.attr_index.append(len(self.attr_name))
+        self.attr_text = ''.join(self._attr_bits)
+        del self._text_bits, self._attr_bits, self._name_ids
+
+    def __len__(self):
+        return len(self.name)
+
+    def node(self, index):
+        '''
+        Proxy for the node at the given index
+        '''
+        if self.name[index] == TEXT_NODE:
+            return text(self, index)
+        return element(self, index)
+
+    @property
+    def root(self):
+        '''
+        Proxy for the document element, or None for an empty store
+        '''
+        return element(self, 0) if len(self.name) else None
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError('Columnar documents are read-only')
+
+
+class element(tree.element):
+    '''
+    Proxy for an element in a store
+    '''
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    @property
+    def xml_name(self):
+        return self._store.names[self._store.name[self._index]]
+
+    @property
+    def xml_attributes(self):
+        st, i = self._store, self._index
+        start, stop = st.attr_index[i], st.attr_index[i+1]
+        if start == stop: return tree.EMPTY_ATTRIBUTES
+        names, attr_name, attr_offset, attr_text = st.names, st.attr_name, st.attr_offset, st.attr_text
+        return { names[attr_name[a]]: attr_text[attr_offset[a]:attr_offset[a+1]] for a in range(start, stop) }
+
+    @property
+    def _xml_children(self):
+        st = self._store
+        end = st.end
+        children = []
+        child = self._index + 1
+        stop = end[self._index]
+        while child < stop:
+            children.append(st.node(child))
+            child = end[child]
+        return children
+
+    @property
+    def xml_children(self):
+        return self._xml_children
+
+    @property
+    def xml_parent(self):
+        parent = self._store.parent[self._index]
+        return element(self._store, parent) if parent != -1 else None
+
+    @property
+    def xml_value(self):
+        st = self._store
+        return st.text[st.text_offset[self._index]:st.text_offset[st.end[self._index]]]
+
+    #Document order is the order of the arrays, so nothing need be labeled, e.g. by uxpath
+    @property
+    def _docorder(self):
+        return self._index
+
+    @_docorder.setter
+    def _docorder(self, value):
+        pass
+
+    xml_append = xml_insert = xml_remove = _read_only
+
+    def __eq__(self, other):
+        return isinstance(other, element) and other._store is self._store and other._index == self._index
+
+    def __hash__(self):
+        return hash((id(self._store), self._index))
+
+    def __reduce__(self):
+        #Pickles as a plain tree
+        return (tree._restore_element, (tree.element, self.xml_name, dict(self.xml_attributes), self._xml_children, None))
+
+
+class text(tree.text):
+    '''
+    Proxy for a text node in a store
+    '''
+    def __new__(cls, store, index):
+        self = str.__new__(cls, store.text[store.text_offset[index]:store.text_offset[index+1]])
+        self._store = store
+        self._index = index
+        return self
+
+    def __init__(self, store, index):
+        pass
+
+    @property
+    def xml_parent(self):
+        return element(self._store, self._store.parent[self._index])
+
+    @property
+    def _docorder(self):
+        return self._index
+
+    @_docorder.setter
+    def _docorder(self, value):
+        pass
+
+    def __reduce__(self):
+        return (tree._restore_text, (tree.text, str(self), None))
+
+
+def parse(doc):
+    '''
+    Parse a MicroXML document into a store, returning the proxy for its document element
+
+    doc - document text, as a string or bytes
+    '''
+    st = store()
+    p = parser(st._handler(), batch=True)
+    p.send((doc, False))
+    p.send(('', True)) #Wrap it up
+    st._finish()
+    return st.root
+
+
+def parse_file(path, encoding=None):
+    '''
+    Parse the MicroXML file at path into a store, returning the proxy for its document element.
+    The file is memory mapped and fed to the parser a chunk at a time
+
+    encoding - encoding of the file. If None, sniffed from the first few bytes
+    '''
+    st = store()
+    p = parser(st._handler(), encoding=encoding, batch=True)
+    for chunk in mapped_chunks(path):
+        p.send((chunk, False))
+    p.send(('', True)) #Wrap it up
+    st._finish()
+    return st.root
+
+
+def parse_xml(source):
+    '''
+    Parse XML 1.0 into a store, through expat, as with amara3.uxml.xml.treebuilder,
+    returning the proxy for its document element
+    '''
+    import xml.parsers.expat
+    from amara3.uxml.xml import expat_callbacks
+    st = store()
+    callbacks = expat_callbacks(st._handler())
+    expat_parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+    expat_parser.StartElementHandler = callbacks.start_element
+    expat_parser.EndElementHandler = callbacks.end_element
+    expat_parser.CharacterDataHandler = callbacks.char_data
+    expat_parser.Parse(source, True)
+    st._finish()
+    return st.root
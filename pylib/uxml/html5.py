@@ -136,6 +136,8 @@ class element(tree.element, node):
         return
 
     def xml_set_attributes_(self, attrs):
+        if self.xml_attributes is tree.EMPTY_ATTRIBUTES:
+            self.xml_attributes = {}
         for key, val in attrs.items():
             if isinstance(key, tuple):
                 self.xml_attributes[qname_to_local(key[1])] = val
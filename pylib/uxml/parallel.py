@@ -0,0 +1,185 @@
+# -----------------------------------------------------------------------------
+# amara3.uxml.parallel
+#
+# Parse large MicroXML record files on several cores at once
+#
+# -----------------------------------------------------------------------------
+
+'''
+Parse documents of the common form of a document element holding a long run
+of record elements, e.g. a database dump such as
+
+<db>
+  <record id="1">...</record>
+  <record id="2">...</record>
+  ...
+</db>
+
+The input is split into chunks, each of whole records, which are parsed in
+separate processes. Since '<' can only start a tag in MicroXML, a split can be
+made before any '<record' found, provided records do not themselves contain
+elements of the same name at any depth, which is detected and reported as an error.
+
+Input must be UTF-8 (or ASCII), so that split points can be found in the raw bytes.
+
+>>> from amara3.uxml import parallel
+>>> for rec in parallel.parse_records('dump.uxml'):
+...     print(rec.xml_attributes['id'])
+'''
+
+import os
+import re
+import gc
+import mmap
+import weakref
+import collections
+import concurrent.futures #https://docs.python.org/3/library/concurrent.futures.html
+
+from amara3.uxml import tree
+from amara3.uxml.parser import sniff_encoding
+
+#Attribute values may contain '>'
+START_TAG = re.compile(rb'<\s*([^\s/>]+)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+
+
+def _find_splits(data, record, chunksize):
+    '''
+    Work out the document element's start tag and name, the record element name,
+    and the offsets of the chunks of records to be parsed separately
+
+    Returns (root_start_tag, root_name, record, offsets), where offsets is a list
+    of positions delimiting the chunks, the first just after the document element's
+    start tag and the last at the start of its end tag
+    '''
+    #Skip any BOM
+    start = 3 if data[:3] == b'\xef\xbb\xbf' else 0
+    if sniff_encoding(data[start:start+4]) not in ('utf-8', 'utf-8-sig'):
+        raise ValueError('Parallel parsing requires UTF-8 input')
+    m = START_TAG.search(data, start)
+    if not m:
+        raise RuntimeError('Incomplete document: no document element')
+    root_start_tag, root_name = m.group(0), m.group(1)
+    first = m.end()
+    last = data.rfind(b'</')
+    if last < first:
+        raise RuntimeError('Incomplete document: input ends before the document element is closed')
+    if record is None:
+        m = START_TAG.search(data, first, last)
+        #No child elements, so no records to parse separately
+        if not m: return root_start_tag, root_name, None, [first, last]
+        record = m.group(1).decode('utf-8')
+    rec_open = b'<' + record.encode('utf-8')
+    offsets = [first]
+    pos = first + chunksize
+    while pos < last:
+        split = data.find(rec_open, pos, last)
+        #Look for the whole name, not just a prefix of another
+        while split != -1 and data[split+len(rec_open):split+len(rec_open)+1] not in b' \t\r\n>':
+            split = data.find(rec_open, split + 1, last)
+        if split == -1: break
+        offsets.append(split)
+        pos = split + chunksize
+    offsets.append(last)
+    return root_start_tag, root_name, record, offsets
+
+
+def _parse_chunk(source, start, end, root_start_tag, root_name):
+    '''
+    Parse one chunk of records in a worker process, returning the list of top-level nodes,
+    i.e. the records and any text between them
+
+    source - path of the file, which is mapped again here, or the bytes of the chunk itself
+    '''
+    if isinstance(source, str):
+        with open(source, 'rb') as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                chunk = mm[start:end]
+    else:
+        chunk = source
+    doc = root_start_tag + chunk + b'</' + root_name + b'>'
+    #Nodes are created in bulk with none becoming garbage, so collection passes would only waste time
+    gc.disable()
+    try:
+        wrapper = tree.treebuilder().parse(doc)
+    except RuntimeError as e:
+        raise ValueError('Unable to parse the records from offset {0}. Might they contain elements of the same name?'.format(start)) from e
+    finally:
+        gc.enable()
+    children = wrapper.xml_children
+    for child in children:
+        child._xml_parent = None
+    return children
+
+
+def _parse_chunks(source, record, workers, chunksize):
+    '''
+    Yield the root element, with no children, then lists of its child nodes, in document order
+    '''
+    if isinstance(source, str):
+        with open(source, 'rb') as fp:
+            if not os.fstat(fp.fileno()).st_size:
+                raise RuntimeError('Incomplete document: no document element')
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                root_start_tag, root_name, record, offsets = _find_splits(mm, record, chunksize)
+        #Workers map the file themselves, rather than being sent its contents
+        sources = [source] * (len(offsets) - 1)
+    else:
+        root_start_tag, root_name, record, offsets = _find_splits(source, record, chunksize)
+        sources = [ source[start:end] for start, end in zip(offsets, offsets[1:]) ]
+    yield tree.treebuilder().parse(root_start_tag + b'</' + root_name + b'>')
+    workers = workers or os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    #Keep only a few tasks per worker in flight, so that parsed records don't pile up unconsumed
+    backlog = 2 * workers
+    pending = collections.deque()
+    try:
+        for chunk_source, start, end in zip(sources, offsets, offsets[1:]):
+            if len(pending) >= backlog:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_parse_chunk, chunk_source, start, end, root_start_tag, root_name))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def parse_records(source, record=None, workers=None, chunksize=1<<24):
+    '''
+    Parse a record file on several processes, yielding the record elements in document order
+
+    source - path of a file, or bytes
+    record - name of the record elements. If None, the name of the first child element of the document element
+    workers - number of worker processes. If None, the number of processors
+    chunksize - approximate number of bytes of records parsed by each task
+    '''
+    chunks = _parse_chunks(source, record, workers, chunksize)
+    next(chunks) #Skip the root
+    for children in chunks:
+        for child in children:
+            if isinstance(child, tree.element):
+                yield child
+
+
+def parse(source, record=None, workers=None, chunksize=1<<24):
+    '''
+    Parse a record file on several processes, returning the whole tree,
+    the same as would be had from amara3.uxml.tree.parse
+
+    source - path of a file, or bytes
+    record - name of the record elements. If None, the name of the first child element of the document element
+    workers - number of worker processes. If None, the number of processors
+    chunksize - approximate number of bytes of records parsed by each task
+    '''
+    #As in the workers, unpickling the results creates nodes in bulk, which is much slower with collection passes
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        chunks = _parse_chunks(source, record, workers, chunksize)
+        root = next(chunks)
+        for children in chunks:
+            for child in children:
+                child._xml_parent = weakref.ref(root)
+            root.xml_children.extend(children)
+    finally:
+        if gc_was_enabled: gc.enable()
+    return root
@@ -7,8 +7,13 @@ Hand-crafted parser for MicroXML [1], inspired to some extent by James Clark's J
 [2] https://github.com/jclark/microxml-js/blob/master/microxml.js
 '''
 
+import os
 import re
-from enum import Enum #https://docs.python.org/3.4/library/enum.html
+import sys
+import mmap
+import codecs
+from collections import namedtuple
+from enum import Enum, IntEnum #https://docs.python.org/3.4/library/enum.html
 
 from amara3.util import coroutine
 
@@ -21,13 +26,105 @@ class state(Enum):
     complete_tag = 6
     complete_doc = 7
     attribute = 8
+    attribute_value = 9
+    skip = 10
 
 
-class event(Enum):
+class event(IntEnum):
+    '''
+    Event types. Members are ints, so the opcodes in an event compare equal whether
+    given as members or as the plain ints 1, 2 & 3 (cf. amara3.uxml.coax)
+
+    end_document is only sent in multidoc mode, as the one-item tuple (end_document,)
+    '''
     start_element = 1
     end_element = 2
     characters = 3
+    end_document = 4
+
+
+#Opcodes for inner dispatch loops, e.g. ev[0] == START_ELEMENT, avoiding attribute lookups on the Enum class
+START_ELEMENT = event.start_element
+END_ELEMENT = event.end_element
+CHARACTERS = event.characters
+END_DOCUMENT = event.end_document
+
+#Likewise for parser states, which are only ever compared by identity
+_PRE_ELEMENT = state.pre_element
+_IN_ELEMENT = state.in_element
+_PRE_TAG_GI = state.pre_tag_gi
+_PRE_COMPLETE_TAG_GI = state.pre_complete_tag_gi
+_COMPLETE_TAG = state.complete_tag
+_COMPLETE_DOC = state.complete_doc
+_ATTRIBUTE = state.attribute
+_ATTRIBUTE_VALUE = state.attribute_value
+_SKIP = state.skip
+
+#Returned by a handler from a start_element event to have the parser skip that element's content
+SKIP = object()
+
+
+class ancestry:
+    '''
+    Names of the elements open at some point in a parse, outermost first.
+    Immutable, and held as a linked chain of parents, so that starting or ending
+    an element is O(1) and each event can share its ancestry with others rather
+    than carrying its own copy of the element stack.
+
+    Behaves like the list of names which events used to carry (and compares equal to one).
+    The list is only built if iterated or indexed; name, parent and depth are cheap
+
+    >>> from amara3.uxml.parser import ancestry
+    >>> a = ancestry().push('a').push('b')
+    >>> a
+    ['a', 'b']
+    >>> a == ['a', 'b'], a.name, a.parent, len(a)
+    (True, 'b', ['a'], 2)
+    '''
+    __slots__ = ('name', 'parent', 'depth')
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+
+    def push(self, name):
+        return ancestry(name, self)
+
+    def __reversed__(self):
+        #Innermost first, straight off the chain
+        a = self
+        while a.parent is not None:
+            yield a.name
+            a = a.parent
 
+    def __iter__(self):
+        names = list(reversed(self))
+        names.reverse()
+        return iter(names)
+
+    def __len__(self):
+        return self.depth
+
+    def __getitem__(self, ix):
+        return list(self)[ix]
+
+    def copy(self):
+        return list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (ancestry, list, tuple)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+NO_ANCESTORS = ancestry()
 
 BOM = '\uFEFF'
 
@@ -68,76 +165,319 @@ WS = '[\u0009\u000A\u0020]'
 
 HEXCHARENTOK = re.compile('[a-fA-F0-9]')
 NAMEDCHARENTOK = re.compile('[a-zA-Z0-9]')
+
+#Patterns for consuming whole runs of characters in one match, e.g. DATACHARS.match(window, pos).end()
+#Each always matches, possibly empty, except NAME, which requires a NAMESTARTCHAR
+SPACES = re.compile('[ \r\n\t]*')
+NAME = re.compile(NAMESTARTCHAR.pattern + NAMECHAR.pattern + '*')
+NAMECHARS = re.compile(NAMECHAR.pattern + '*')
+DATACHARS = re.compile(DATACHAR.pattern + '*')
+ATTRIBVALCHARS_SGL = re.compile(ATTRIBVALCHAR_SGL.pattern + '*')
+ATTRIBVALCHARS_DBL = re.compile(ATTRIBVALCHAR_DBL.pattern + '*')
+HEXCHARENTOKS = re.compile(HEXCHARENTOK.pattern + '*')
+NAMEDCHARENTOKS = re.compile(NAMEDCHARENTOK.pattern + '*')
 #In order of length
 CHARNAMES =  (('lt', "<"), ('gt', ">"), ('amp', "&"), ('quot', '"'), ('apos', "'"))
 #CHARNAMES = { 'lt': "<", 'gt': ">", 'amp': "&", 'quot': '"', 'apos': "'"}
 
 #Make this one a utility function since we'll hope to make the transition into reading cdata rarely enough to endure the function-call overhead
-def handle_cdata(pos, window, charpat, stopchars):
+def handle_cdata(pos, window, charpat, stopchars, partial=None):
     '''
     Return (result, new_position) tuple.
     Result is cdata string if possible and None if more input is needed
     Or of course bad syntax can raise a RuntimeError
+
+    charpat - compiled pattern matching a (possibly empty) run of allowed characters, e.g. DATACHARS
+    partial - optional list. If given, cdata read before running out of input is appended to it
+        and new_position is where scanning should resume once more input is available, so that
+        long runs of cdata split across fragments are never rescanned. Once the cdata is complete
+        the accumulated bits are prepended to the result and the list is cleared
     '''
-    cdata = ''
+    cdata = []
     cursor = start = pos
+    amp = None #Position of the '&' of a character reference being read, if any
 
     try:
         while True:
-            while charpat.match(window[cursor]):
-                cursor += 1
-            addchars = window[start:cursor]
-            cdata += addchars
+            #Consume the whole run of plain characters in one go
+            cursor = charpat.match(window, cursor).end()
+            cdata.append(window[start:cursor])
             #if window[pos] != openattr:
             #    raise RuntimeError('Mismatch in attribute quotes')
             if window[cursor] in stopchars:
-                return cdata, cursor
+                if partial:
+                    cdata = partial + cdata
+                    partial.clear()
+                return ''.join(cdata), cursor
             #Check for charref
             elif window[cursor] == '&':
+                amp = cursor
                 start = cursor = cursor + 1
                 if window[cursor] == '#' and window[cursor + 1] == 'x':
                     #Numerical charref
                     start = cursor = cursor + 2
-                    while True:
-                        if HEXCHARENTOK.match(window[cursor]):
-                            cursor += 1
-                        elif window[cursor] == ';':
-                            c = chr(int(window[start:cursor], 16))
-                            if not CHARACTER.match(c):
-                                raise RuntimeError('Character reference gives an illegal character: {0}'.format('&' + window[start:cursor] + ';'))
-                            cdata += c
-                            break
-                        else:
-                            raise RuntimeError('Illegal in character entity: {0}'.format(window[cursor]))
+                    cursor = HEXCHARENTOKS.match(window, cursor).end()
+                    if window[cursor] == ';':
+                        c = chr(int(window[start:cursor], 16))
+                        if not CHARACTER.match(c):
+                            raise RuntimeError('Character reference gives an illegal character: {0}'.format('&' + window[start:cursor] + ';'))
+                        cdata.append(c)
+                    else:
+                        raise RuntimeError('Illegal in character entity: {0}'.format(window[cursor]))
                 else:
                     #Named charref
-                    while True:
-                        if NAMEDCHARENTOK.match(window[cursor]):
-                            cursor += 1
-                        elif window[cursor] == ';':
-                            for cn, c in CHARNAMES:
-                                if window[start:cursor] == cn:
-                                    cdata += c
-                                    #cursor += 1 #Skip ;
-                                    break
-                            else:
-                                raise RuntimeError('Unknown named character reference: {0}'.format(repr(window[start:cursor])))
-                            break
+                    cursor = NAMEDCHARENTOKS.match(window, cursor).end()
+                    if window[cursor] == ';':
+                        for cn, c in CHARNAMES:
+                            if window[start:cursor] == cn:
+                                cdata.append(c)
+                                #cursor += 1 #Skip ;
+                                break
                         else:
-                            raise RuntimeError('Illegal in character reference: {0} (around {1})'.format(window[cursor]), error_context(window, start, cursor))
+                            raise RuntimeError('Unknown named character reference: {0}'.format(repr(window[start:cursor])))
+                    else:
+                        raise RuntimeError('Illegal in character reference: {0} (around {1})'.format(window[cursor], error_context(window, start, cursor)))
+                amp = None
+            #Otherwise a character not allowed here, which is skipped, as it always has been
             #print(start, cursor, cdata, window[cursor])
             cursor += 1
             start = cursor
     except IndexError:
-        return None, cursor
+        if partial is None:
+            return None, cursor
+        #Everything up to the run of plain characters just read, or up to any character reference being read, is in cdata
+        partial.extend(cdata)
+        if amp is None:
+            #Ran out of input at the end of a run of plain characters
+            return None, cursor
+        #Ran out of input within a character reference, which will have to be reread from its start
+        return None, amp
+
+#For decoding raw cdata in one pass: a character reference, or a character not allowed in the context, to be dropped
+_REF_OR_DISALLOWED = '&(?:#x(?P<hex>[a-fA-F0-9]*)|(?P<name>[a-zA-Z0-9]*))(?P<semi>;?)|[^{0}'
+DATA_DECODE = re.compile(_REF_OR_DISALLOWED.format(DATACHAR.pattern[1:]))
+ATTRIBVAL_SGL_DECODE = re.compile(_REF_OR_DISALLOWED.format(ATTRIBVALCHAR_SGL.pattern[1:]))
+ATTRIBVAL_DBL_DECODE = re.compile(_REF_OR_DISALLOWED.format(ATTRIBVALCHAR_DBL.pattern[1:]))
+CHARNAME_MAP = dict(CHARNAMES)
+
+def _decode_match(m):
+    if m.group('semi') is None:
+        return '' #A disallowed character, which is skipped
+    hexref, name = m.group('hex', 'name')
+    if hexref is not None:
+        if not hexref or not m.group('semi'):
+            raise RuntimeError('Illegal character entity: {0}'.format(m.group()))
+        c = chr(int(hexref, 16))
+        if not CHARACTER.match(c):
+            raise RuntimeError('Character reference gives an illegal character: {0}'.format(m.group()))
+        return c
+    if not m.group('semi'):
+        raise RuntimeError('Illegal character reference: {0}'.format(m.group()))
+    try:
+        return CHARNAME_MAP[name]
+    except KeyError:
+        raise RuntimeError('Unknown named character reference: {0}'.format(repr(name))) from None
+
+
+def decode_cdata(raw, decodepat=DATA_DECODE):
+    '''
+    Decode cdata as it appears in the source, in the same way as handle_cdata,
+    but in one pass over the whole string
+
+    decodepat - DATA_DECODE for element content, or ATTRIBVAL_SGL_DECODE or
+        ATTRIBVAL_DBL_DECODE for single or double quoted attribute values
+    '''
+    return decodepat.sub(_decode_match, raw)
+
+
+class rawtext:
+    '''
+    Character data as it appears in the source, sent in place of str by a parser
+    in lazy mode. Character references are decoded only when the value is first asked for,
+    so text which is discarded unread is never decoded
+
+    raw - the source text
+    has_refs - False if raw is already the value, i.e. holds no character references
+        (nor characters to be skipped), so no decoding is needed
+
+    >>> from amara3.uxml.parser import rawtext
+    >>> t = rawtext('a&amp;b', True)
+    >>> t.value
+    'a&b'
+    '''
+    __slots__ = ('raw', 'has_refs', '_decodepat', '_value')
+
+    def __init__(self, raw, has_refs, decodepat=DATA_DECODE):
+        self.raw = raw
+        self.has_refs = has_refs
+        self._decodepat = decodepat
+        self._value = None if has_refs else raw
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = decode_cdata(self.raw, self._decodepat)
+        return self._value
+
+    def __str__(self):
+        return self.value
+
+    def __eq__(self, other):
+        if isinstance(other, rawtext):
+            return self.value == other.value
+        if isinstance(other, str):
+            return self.value == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return 'rawtext({0!r}, {1!r})'.format(self.raw, self.has_refs)
+
+
+def handle_rawdata(pos, window, charpat, stopchar, partial):
+    '''
+    Counterpart of handle_cdata for lazy mode, which decodes nothing, returning a
+    (raw, has_refs, new_position) tuple, with raw None if more input is needed.
+    Bits read before running out of input are appended to partial
+    '''
+    cursor = charpat.match(window, pos).end()
+    has_refs = False
+    if cursor < len(window) and window[cursor] != stopchar:
+        #A character reference, or character to skip. Either way the value can be found later by decoding
+        has_refs = True
+        cursor = window.find(stopchar, cursor)
+        if cursor == -1: cursor = len(window)
+    if cursor == len(window):
+        partial.append(window[pos:cursor])
+        return None, False, cursor
+    raw = window[pos:cursor]
+    if partial:
+        partial.append(raw)
+        raw = ''.join(partial)
+        partial.clear()
+        #Simpler to check the whole value again than to carry has_refs over from the earlier bits
+        has_refs = charpat.fullmatch(raw) is None
+    return raw, has_refs, cursor
+
 
 def error_context(window, start, end, size=10):
     return window[max(0, start-size):min(end+size, len(window))]
 
 
+def sniff_encoding(prefix):
+    '''
+    Guess the encoding of serialized (Micro)XML from its first few bytes, using the same
+    signatures as isxml in clib/xmlstring.c (see http://www.w3.org/TR/REC-xml/#sec-guessing)
+
+    prefix - at least the first 4 bytes of the input, if available
+    Returns an encoding name suitable for codecs.getincrementaldecoder. Where there is a
+    byte order mark the codec chosen will strip it from the decoded text.
+    Raises RuntimeError for signatures of encodings Python cannot decode
+
+    >>> from amara3.uxml.parser import sniff_encoding
+    >>> sniff_encoding(b'\\xff\\xfe<\\x00')
+    'utf-16'
+    '''
+    prefix = bytes(prefix[:4])
+    if len(prefix) == 4:
+        if prefix in (b'\x00\x00\xfe\xff', b'\xff\xfe\x00\x00'):
+            #BOM UCS-4
+            return 'utf-32'
+        if prefix in (b'\x00\x00\xff\xfe', b'\xfe\xff\x00\x00'):
+            raise RuntimeError('Unsupported encoding: UCS-4 in unusual (2143 or 3412) byte order')
+        if prefix == b'\x00\x00\x00<':
+            return 'utf-32-be'
+        if prefix == b'<\x00\x00\x00':
+            return 'utf-32-le'
+    if prefix.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    if prefix[:2] in (b'\xfe\xff', b'\xff\xfe'):
+        return 'utf-16'
+    if prefix[:2] == b'\x00<':
+        return 'utf-16-be'
+    if prefix[:2] == b'<\x00':
+        return 'utf-16-le'
+    #UTF-8 without encoding declaration, which is all that MicroXML proper allows anyway
+    return 'utf-8'
+
+
+checkpoint = namedtuple('checkpoint', ('offset', 'byte_offset', 'elements', 'encoding'))
+checkpoint.__doc__ = '''
+Point at an element boundary in a parse, from which it can be resumed
+
+offset - number of characters of input before this point
+byte_offset - number of bytes of input before this point, or None if the input was str
+elements - names of the elements open at this point, outermost first
+encoding - codec for decoding bytes input from this point, or None if the input was str
+'''
+
+
+def _resume_encoding(encoding, prefix):
+    '''
+    Name of the codec which decodes the input from any point after its start,
+    i.e. without expecting a byte order mark
+
+    prefix - the first few bytes of input
+    '''
+    name = codecs.lookup(encoding).name
+    if name == 'utf-8-sig':
+        return 'utf-8'
+    if name in ('utf-16', 'utf-32'):
+        if prefix.startswith(b'\xff\xfe'):
+            return name + '-le'
+        if prefix.startswith(b'\xfe\xff') or prefix.startswith(b'\x00\x00\xfe\xff'):
+            return name + '-be'
+        return name + ('-le' if sys.byteorder == 'little' else '-be')
+    return name
+
+
 @coroutine
-def parser(handler, strict=True):
+def parser(handler, strict=True, encoding=None, batch=False, batch_limit=1024, symbols=None, lazy=False,
+            checkpoints=False, resume=None, multidoc=False):
+    '''
+    Parser coroutine. Send it (fragment, done) tuples, where done is True for the last fragment.
+    Sends MicroXML events to the handler coroutine
+
+    Fragments can be str, or bytes-like objects (e.g. bytes or memoryview) which are decoded
+    incrementally, so that multi-byte sequences may be split across fragments.
+    Bytes that cannot be decoded, including an incomplete multi-byte sequence at the end, raise RuntimeError
+
+    handler - coroutine to which events are sent
+    encoding - encoding of any bytes fragments. If None, sniffed from the first few bytes
+    batch - if True, rather than sending each event as it comes, send the handler one list
+        of all the events arising from each fragment, saving the cost of resuming it per event.
+        Large fragments are delivered in several lists of at most batch_limit events, to bound memory
+    batch_limit - maximum number of events in each list in batch mode
+    symbols - optional dict used as symbol table, through which element and attribute names
+        are interned, so that all occurrences of a name share one string object. Pass the same
+        dict to several parses to share names across them. By default a fresh one per parse
+    lazy - if True, text in characters events and attribute values are rawtext objects,
+        whose character references are only decoded on access, and errors in them only reported then
+    checkpoints - if True, each send() returns a checkpoint for the last element boundary
+        (just after a tag, or just before the tag following text) among the input so far,
+        or None if there is none yet. Every event before it has been sent to the handler.
+        The offsets in the checkpoint assume a codec where each character of input is
+        always encoded the same way, as with the UTF and ISO-8859 encodings
+    resume - checkpoint from an earlier parse of the same input, from which to carry on.
+        Fragments sent should then start from the checkpoint's offset (or byte_offset for bytes),
+        e.g. after a file seek, and events are sent as if parsing had not been interrupted
+    multidoc - if True, parse a stream of any number of documents, one after another,
+        optionally separated by whitespace, e.g. messages on a long-lived connection.
+        After each document element's end_element event an (end_document,) event is sent
+
+    Outside batch mode, a handler which yields SKIP in response to a start_element event
+    (i.e. `ev = yield SKIP`) has the parser pass over the content of that element, with no
+    events and only enough work to find the matching end tag, whose end_element event is then sent.
+    Nesting is balanced by counting tags, so element names within a skipped subtree are not checked
+    '''
     next(handler) #Prime the coroutine
+    if batch:
+        batched = []
+        send = batched.append
+    else:
+        send = handler.send
     #abspos = 0
     line_count = 1
     col_count = 1
@@ -145,128 +485,219 @@ def parser(handler, strict=True):
     pos = 0
     wlen = 0
     backtrack = 0
-    curr_state = state.pre_element
+    curr_state = _PRE_ELEMENT
     done = False
-    element_stack = []
+    ancestors = NO_ANCESTORS
+    skip_depth = 0
+    if symbols is None: symbols = {}
+    intern = symbols.setdefault
     attribs = {}
+    pending_chars = [] #Bits of character data read before running out of input
+    decoder = None
+    sniff_buf = b'' #Leading bytes held back until there are enough to sniff the encoding
+    window_start = 0 #Number of characters of input before the window
+    bytes_in = 0
+    resume_encoding = None
+    latest_cp = None
+    cp_pos = None #Position in the window of an element boundary since the latest checkpoint
+    if resume is not None:
+        window_start = resume.offset
+        bytes_in = resume.byte_offset or 0
+        if resume.encoding:
+            encoding = resume_encoding = resume.encoding
+        for name in resume.elements:
+            ancestors = ancestors.push(intern(name, name))
+        curr_state = _IN_ELEMENT if ancestors.depth else _PRE_ELEMENT if multidoc else _COMPLETE_DOC
+        latest_cp = resume
     try:
         try:
             while not done:
-                #import pdb; pdb.set_trace()
-                frag, done = yield
+                if cp_pos is not None:
+                    if decoder is None:
+                        byte_offset = None
+                    else:
+                        #All decoded input is in the window, so count back from the total decoded
+                        decoded_bytes = bytes_in - len(decoder.getstate()[0])
+                        byte_offset = decoded_bytes - len(codecs.encode(window[cp_pos:], resume_encoding))
+                    latest_cp = checkpoint(window_start + cp_pos, byte_offset, tuple(ancestors), resume_encoding)
+                    cp_pos = None
+                frag, done = yield latest_cp
                 #print(frag, done)
-                if not frag: continue #Ignore empty additions
+                try:
+                    if not isinstance(frag, str):
+                        if checkpoints: bytes_in += len(frag)
+                        if decoder is None:
+                            if encoding is None and (sniff_buf or len(frag) < 4):
+                                sniff_buf += frag
+                                if len(sniff_buf) < 4 and not done: continue
+                                frag, sniff_buf = sniff_buf, b''
+                            codec = encoding or sniff_encoding(frag)
+                            decoder = codecs.getincrementaldecoder(codec)()
+                            if checkpoints and not resume_encoding:
+                                resume_encoding = _resume_encoding(codec, frag[:4])
+                        frag = decoder.decode(frag, done)
+                    elif done and decoder is not None:
+                        #Flush, which also catches any incomplete multi-byte sequence at the end
+                        frag = decoder.decode(b'', True) + frag
+                except UnicodeDecodeError as e:
+                    raise RuntimeError('Unable to decode input: {0}'.format(e)) from e
+                if not frag:
+                    if done and curr_state is not _COMPLETE_DOC:
+                        #In multidoc mode the stream may end between documents
+                        if not (multidoc and curr_state is _PRE_ELEMENT and SPACES.fullmatch(window, pos)):
+                            raise RuntimeError('Incomplete document: input ends before the document element is closed')
+                    continue #Ignore empty additions
+                if pos:
+                    #Throw away the consumed part of the window. Any backtracking goes no further back than pos,
+                    #so only the unconsumed tail need be kept, with positions rebased to its start
+                    window = window[pos:]
+                    window_start += pos
+                    pos = 0
                 window += frag
-                wlen += len(frag)
-                #FIXME: throw away unneeded, prior bits of window here
+                wlen = len(window)
                 need_input = False
 
                 while not need_input:
-                    if curr_state == state.pre_element:
+                    if batch and len(batched) >= batch_limit:
+                        handler.send(batched)
+                        batched = []
+                        send = batched.append
+                    if curr_state is _SKIP:
+                        #Every '<' opens a tag, since it can occur neither in content nor attribute values
+                        while True:
+                            lt = window.find('<', pos)
+                            if lt == -1:
+                                pos = wlen
+                                break
+                            tagpos = SPACES.match(window, lt+1).end()
+                            if tagpos == wlen:
+                                #Come back to this tag once we can tell whether it's an end tag
+                                pos = lt
+                                break
+                            pos = tagpos
+                            if window[tagpos] == '/':
+                                skip_depth -= 1
+                                if not skip_depth:
+                                    #The end tag of the skipped element, which is parsed as usual
+                                    pos += 1
+                                    curr_state = _PRE_COMPLETE_TAG_GI
+                                    break
+                            else:
+                                skip_depth += 1
+                        if curr_state is _SKIP:
+                            if done: raise RuntimeError('Incomplete document: input ends before the document element is closed')
+                            need_input = True
+                            continue
+                    if curr_state is _PRE_ELEMENT:
                         #Eat up any whitespace
-                        try:
-                            while window[pos] in ' \r\n\t':
-                                pos += 1
-                        except IndexError:
-                            if not done: need_input = True #Do not advance until we have enough input
+                        pos = SPACES.match(window, pos).end()
+                        if pos == wlen:
+                            if done:
+                                if multidoc: break #Input may end between documents
+                                raise RuntimeError('Incomplete document: input ends before the document element')
+                            need_input = True #Do not advance until we have enough input
                             continue
                         #if not done and pos == wlen:
                         #    need_input = True
                         #    continue
                         if window[pos] == '<':
                             pos += 1
-                            curr_state = state.pre_tag_gi
+                            curr_state = _PRE_TAG_GI
+                        else:
+                            raise RuntimeError('Junk before document element (around {0})'.format(error_context(window, pos, pos)))
                         #if not done and pos == wlen:
                         #    need_input = True
                         #    continue
-                    if curr_state in (state.pre_tag_gi, state.pre_complete_tag_gi):
-                        pending_event = event.start_element if curr_state == state.pre_tag_gi else event.end_element
+                    if curr_state is _PRE_TAG_GI or curr_state is _PRE_COMPLETE_TAG_GI:
+                        pending_event = START_ELEMENT if curr_state is _PRE_TAG_GI else END_ELEMENT
                         #Eat up any whitespace
-                        try:
-                            while window[pos] in ' \r\n\t':
-                                pos += 1
-                        except IndexError:
-                            if not done: need_input = True #Do not advance until we have enough input
+                        pos = SPACES.match(window, pos).end()
+                        if pos == wlen:
+                            if done: raise RuntimeError('Incomplete document: input ends within a tag')
+                            need_input = True #Do not advance until we have enough input
                             continue
-                        if curr_state == state.pre_tag_gi and window[pos] == '/':
+                        if curr_state is _PRE_TAG_GI and window[pos] == '/':
                             pos += 1
-                            curr_state = state.pre_complete_tag_gi
-                            pending_event = event.end_element
+                            curr_state = _PRE_COMPLETE_TAG_GI
+                            pending_event = END_ELEMENT
                             continue
                         #if not done and pos == wlen:
                         #    need_input = True
                         #    continue
-                        advpos = pos
-                        try:
-                            if NAMESTARTCHAR.match(window[advpos]):
-                                advpos += 1
-                                while NAMECHAR.match(window[advpos]):
-                                    advpos += 1
-                        except IndexError:
-                            if not done: need_input = True #Do not advance until we have enough input
+                        m = NAME.match(window, pos)
+                        advpos = m.end() if m else pos
+                        if advpos == wlen:
+                            if done: raise RuntimeError('Incomplete document: input ends within a tag')
+                            need_input = True #The name might continue in the next fragment
                             continue
-                        else:
-                            gi = window[pos:advpos]
-                            pos = advpos
-                            curr_state = state.complete_tag
-                    if curr_state == state.complete_tag:
+                        gi = window[pos:advpos]
+                        gi = intern(gi, gi)
+                        pos = advpos
+                        curr_state = _COMPLETE_TAG
+                    if curr_state is _COMPLETE_TAG:
                         #Eat up any whitespace
-                        try:
-                            while window[pos] in ' \r\n\t':
-                                pos += 1
-                        except IndexError:
-                            if not done: need_input = True #Do not advance until we have enough input
+                        pos = SPACES.match(window, pos).end()
+                        if pos == wlen:
+                            if done: raise RuntimeError('Incomplete document: input ends within a tag')
+                            need_input = True #Do not advance until we have enough input
                             continue
                         #Check for attributes
-                        if pending_event == event.start_element and NAMESTARTCHAR.match(window[pos]):
-                            curr_state = state.attribute
+                        if pending_event is START_ELEMENT and NAMESTARTCHAR.match(window[pos]):
+                            curr_state = _ATTRIBUTE
                             #Note: pos not advanced so we can re-read startchar
                             continue
 
                         if window[pos] == '>':
                             pos += 1
-                            curr_state = state.in_element
-                            attribs_out = attribs.copy()
+                            curr_state = _IN_ELEMENT
+                            attribs_out = attribs
                             attribs = {} # Reset attribs
-                            if pending_event == event.start_element:
-                                handler.send((pending_event, gi, attribs_out, element_stack.copy()))
-                                element_stack.append(gi)
+                            if pending_event is START_ELEMENT:
+                                if send((pending_event, gi, attribs_out, ancestors)) is SKIP:
+                                    curr_state = _SKIP
+                                    skip_depth = 1
+                                ancestors = ancestors.push(gi)
                             else:
-                                opened = element_stack.pop()
+                                opened = ancestors.name
                                 if opened != gi:
                                     raise RuntimeError('Expected close element {0}, found {1}'.format(opened, gi))
-                                handler.send((pending_event, gi, element_stack.copy()))
-                                if not element_stack: #and if strict
-                                    curr_state = state.complete_doc
+                                ancestors = ancestors.parent
+                                send((pending_event, gi, ancestors))
+                                if not ancestors.depth: #and if strict
+                                    if multidoc:
+                                        send((END_DOCUMENT,))
+                                        curr_state = _PRE_ELEMENT
+                                    else:
+                                        curr_state = _COMPLETE_DOC
+                            if checkpoints and curr_state is not _SKIP: cp_pos = pos
                             if pos == wlen:
                                 if done:
-                                    #Error: unfinished business if this is opening tag
+                                    if curr_state is not _COMPLETE_DOC and not (multidoc and curr_state is _PRE_ELEMENT):
+                                        raise RuntimeError('Incomplete document: input ends before the document element is closed')
                                     break
                                 else:
                                     need_input = True
                                     continue
                         else:
                             raise RuntimeError('Expected \'>\', found {0}'.format(window[pos]))
-                    if curr_state == state.attribute:
+                    if curr_state is _ATTRIBUTE:
                         backtrackpos = pos
-                        advpos = pos+1 #Skip 1st char, which we know is NAMESTARTCHAR
-                        try:
-                            while NAMECHAR.match(window[advpos]):
-                                advpos += 1
-                        except IndexError:
-                            if not done: need_input = True #Do not advance until we have enough input
+                        #Skip 1st char, which we know is NAMESTARTCHAR
+                        advpos = NAMECHARS.match(window, pos+1).end()
+                        if advpos == wlen:
+                            if done: raise RuntimeError('Incomplete document: input ends within a tag')
+                            need_input = True #The name might continue in the next fragment
                             pos = backtrackpos
                             continue
-                        else:
-                            aname = window[pos:advpos]
-                            pos = advpos
+                        aname = window[pos:advpos]
+                        aname = intern(aname, aname)
+                        pos = advpos
 
                         #Eat up any whitespace
-                        try:
-                            while window[pos] in ' \r\n\t':
-                                pos += 1
-                        except IndexError:
-                            if not done: need_input = True #Do not advance until we have enough input
+                        pos = SPACES.match(window, pos).end()
+                        if pos == wlen:
+                            if done: raise RuntimeError('Incomplete document: input ends within a tag')
+                            need_input = True #Do not advance until we have enough input
                             pos = backtrackpos
                             continue
 
@@ -274,49 +705,67 @@ def parser(handler, strict=True):
                             pos += 1
                         else:
                             raise RuntimeError('Expected \'=\', found {0} (around {1})'.format(window[pos], error_context(window, pos, pos)))
-                        if not done and pos == wlen:
+                        if pos == wlen:
+                            if done: raise RuntimeError('Incomplete document: input ends within a tag')
                             need_input = True
                             pos = backtrackpos
                             continue
 
                         if window[pos] in '"\'':
                             openattr = window[pos]
-                            attrpat = ATTRIBVALCHAR_SGL if openattr == "'" else ATTRIBVALCHAR_DBL
-                            #backtrackpos = pos
-                            #pos + 1 to skip the opening quote
-                            aval, newpos = handle_cdata(pos+1, window, attrpat, openattr)
-                            if aval == None:
-                                if not done: need_input = True
-                                #Don't advance to newpos, so effectively backtrack
-                                continue
-                                #if window[pos] != openattr:
-                                #    raise RuntimeError('Mismatch in attribute quotes')
-                            pos = newpos + 1 #Skip the closing quote
-                            attribs[aname] = aval
-                            curr_state = state.complete_tag
-                    if curr_state == state.in_element:
-                        chars, newpos = handle_cdata(pos, window, DATACHAR, '<')
-                        if chars == None:
-                            if not done: need_input = True
-                            #Don't advance to newpos, so effectively backtrack
+                            attrpat = ATTRIBVALCHARS_SGL if openattr == "'" else ATTRIBVALCHARS_DBL
+                            pos += 1 #Skip the opening quote
+                            #From here on the value is read in its own state, so it need not be rescanned from backtrackpos
+                            curr_state = _ATTRIBUTE_VALUE
+                        else:
+                            raise RuntimeError('Expected quote, found {0} (around {1})'.format(window[pos], error_context(window, pos, pos)))
+                    if curr_state is _ATTRIBUTE_VALUE:
+                        if lazy:
+                            aval, has_refs, newpos = handle_rawdata(pos, window, attrpat, openattr, pending_chars)
+                            if aval is not None:
+                                aval = rawtext(aval, has_refs, ATTRIBVAL_SGL_DECODE if openattr == "'" else ATTRIBVAL_DBL_DECODE)
+                        else:
+                            aval, newpos = handle_cdata(pos, window, attrpat, openattr, pending_chars)
+                        if aval is None:
+                            if done:
+                                raise RuntimeError('Incomplete document: input ends within an attribute value')
+                            need_input = True
+                            #Value read so far is held in pending_chars, so newpos is safe to advance to
+                            pos = newpos
+                            continue
+                        pos = newpos + 1 #Skip the closing quote
+                        attribs[aname] = aval
+                        curr_state = _COMPLETE_TAG
+                    if curr_state is _IN_ELEMENT:
+                        if lazy:
+                            chars, has_refs, newpos = handle_rawdata(pos, window, DATACHARS, '<', pending_chars)
+                            if chars: chars = rawtext(chars, has_refs)
+                        else:
+                            chars, newpos = handle_cdata(pos, window, DATACHARS, '<', pending_chars)
+                        if chars is None:
+                            if done:
+                                raise RuntimeError('Incomplete document: input ends within element content')
+                            need_input = True
+                            #Characters read so far are held in pending_chars, so newpos is safe to advance to
+                            pos = newpos
                             continue
                         pos = newpos
-                        if chars: handler.send((event.characters, chars))
+                        if chars:
+                            send((CHARACTERS, chars))
+                            if checkpoints: cp_pos = pos
                         if window[pos] == '<':
                             pos += 1
                         #advpos = pos
                         #if not done and pos == wlen:
                         #    need_input = True
                         #    continue
-                        curr_state = state.pre_tag_gi
-                    if curr_state == state.complete_doc:
+                        curr_state = _PRE_TAG_GI
+                    if curr_state is _COMPLETE_DOC:
                         if pos == wlen:
                             break #All done!
                         #Eat up any whitespace
-                        try:
-                            while window[pos] in ' \r\n\t':
-                                pos += 1
-                        except IndexError:
+                        pos = SPACES.match(window, pos).end()
+                        if pos == wlen:
                             if not done: need_input = True #Do not advance until we have enough input
                             continue
                         #if not done and pos == wlen:
@@ -328,6 +777,10 @@ def parser(handler, strict=True):
                             raise RuntimeError('Junk after document element')
                     #print('END1')
                 #print('END2')
+                if batch and batched:
+                    handler.send(batched)
+                    batched = []
+                    send = batched.append
             sentinel = yield #Avoid StopIteration in parent from running off enf of coroutine?
         except GeneratorExit:
             #close() called
@@ -343,34 +796,160 @@ echo "for e in parsefrags(('<spa', 'm>eggs</spam>')): print(e)" >> /tmp/spam.py
 python -m pdb -c "b /Users/uche/.local/venv/py3/lib/python3.3/site-packages/amara3/uxml/parser.py:173" /tmp/spam.py
 '''
 
-@coroutine
+#Not decorated with @coroutine because parser primes its handler
 def handler(accumulator):
     while True:
         event = yield
-        accumulator.append(event)
+        if isinstance(event, list):
+            #Batch of events
+            accumulator.extend(event)
+        else:
+            accumulator.append(event)
     return
 
 
-def parse(text):
-    acc = []
-    h = handler(acc)
-    p = parser(h)
-    p.send((text, True))
-    p.close()
-    h.close()
-    for event in acc:
-        yield event
-
-
-def parsefrags(textfrags):
-    acc = []
-    h = handler(acc)
-    p = parser(h)
-    #fragcount = len(textfrags)
-    for i, frag in enumerate(textfrags):
-        p.send((frag, False))
-    p.send(('', True)) #Wrap it up
-    p.close()
-    h.close()
-    for event in acc:
-        yield event
+def _chunks(source, chunksize):
+    '''
+    Yield the fragments of an iterparse source, as (fragment, done) tuples
+    '''
+    if isinstance(source, (str, bytes, bytearray, memoryview)):
+        #Feed in slices, so that events are handed on without waiting for the whole document
+        frags = (source[i:i+chunksize] for i in range(0, len(source), chunksize))
+    elif getattr(source, 'read', None) is not None:
+        read = source.read
+        frags = iter(lambda: read(chunksize), source.read(0))
+    else:
+        frags = iter(source)
+    #Look one fragment ahead so that the last one can be sent with done=True
+    prev = next(frags, None)
+    if prev is None:
+        yield '', True
+        return
+    for frag in frags:
+        yield prev, False
+        prev = frag
+    yield prev, True
+
+
+class feeder(object):
+    '''
+    A parser with its events gathered, to be fed fragments of input however they arrive.
+    The common core of iterparse and amara3.uxml.aio.iterparse
+
+    Arguments as for iterparse
+    '''
+    def __init__(self, encoding=None, lazy=False, on_checkpoint=None, resume=None, multidoc=False):
+        self._events = []
+        self._handler = handler(self._events)
+        self._parser = parser(self._handler, encoding=encoding, batch=True, lazy=lazy,
+                    checkpoints=on_checkpoint is not None, resume=resume, multidoc=multidoc)
+        self._on_checkpoint = on_checkpoint
+        self._latest_cp = self._pending_cp = resume
+
+    def send(self, frag, done=False):
+        '''
+        Parse a fragment, returning a list of the events arising from it,
+        which is only valid until the next call
+
+        done - True for the last fragment
+        '''
+        self._events.clear()
+        cp = self._parser.send((frag, done))
+        if self._on_checkpoint is not None: self._pending_cp = cp
+        return self._events
+
+    def checkpoint(self):
+        '''
+        Report any new checkpoint to on_checkpoint. Call once the events before it have been handled
+        '''
+        cp = self._pending_cp
+        if self._on_checkpoint is not None and cp is not self._latest_cp:
+            self._on_checkpoint(cp)
+            self._latest_cp = cp
+
+    def close(self):
+        self._parser.close()
+        self._handler.close()
+
+
+def iterparse(source, encoding=None, chunksize=65536, lazy=False, on_checkpoint=None, resume=None, multidoc=False):
+    '''
+    Parse MicroXML incrementally, yielding events as they are parsed,
+    so that memory use is bounded by the chunk size rather than the document size
+
+    source - str or bytes holding the whole document, a file-like object
+        (text or binary) from which chunks are read, or an iterable of fragments
+    encoding - encoding of bytes input. If None, sniffed from the first few bytes
+    chunksize - number of characters (or bytes) read at a time from a file-like source
+    lazy - if True, text and attribute values are rawtext objects, decoded on access (see parser)
+    on_checkpoint - optional function called with each new checkpoint (see parser),
+        once every event before it has been yielded
+    resume - checkpoint from an earlier parse from which to carry on, in which case
+        source should start from the checkpoint's offset (or byte_offset for bytes)
+    multidoc - if True, source is a stream of any number of documents, each followed by
+        an (end_document,) event (see parser)
+
+    >>> from amara3.uxml.parser import iterparse
+    >>> for ev in iterparse(open('spam.uxml', 'rb')): print(ev)
+
+    >>> fp = open('spam.uxml', 'rb')
+    >>> fp.seek(saved.byte_offset)
+    >>> for ev in iterparse(fp, resume=saved, on_checkpoint=save): print(ev)
+    '''
+    feed = feeder(encoding=encoding, lazy=lazy, on_checkpoint=on_checkpoint, resume=resume, multidoc=multidoc)
+    try:
+        for frag, done in _chunks(source, chunksize):
+            yield from feed.send(frag, done)
+            feed.checkpoint()
+    finally:
+        feed.close()
+
+
+def mapped_chunks(path, chunksize=1<<20, start=0):
+    '''
+    Yield the contents of the file at path as bytes chunks, sliced from a memory mapping
+    of the file, so that only one chunk at a time need be held in memory
+
+    path - file system path of the file
+    chunksize - number of bytes in each chunk
+    start - offset of the first byte to yield
+    '''
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if start >= size: return #Nothing to yield, and empty files can't be mapped
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'): mm.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(start, size, chunksize):
+                yield mm[offset:offset+chunksize]
+
+
+def parse_file(path, encoding=None, chunksize=1<<20, lazy=False, on_checkpoint=None, resume=None, multidoc=False):
+    '''
+    Parse the MicroXML file at path, yielding events as they are parsed.
+    The file is memory mapped and decoded incrementally, a chunk at a time,
+    so that neither it nor its decoded text need be in memory all at once
+
+    >>> from amara3.uxml.parser import parse_file
+    >>> for ev in parse_file('spam.uxml'): print(ev)
+
+    path - file system path of the file
+    encoding - encoding of the file. If None, sniffed from the first few bytes
+    chunksize - number of bytes decoded and parsed at a time
+    lazy - if True, text and attribute values are rawtext objects, decoded on access (see parser)
+    on_checkpoint - optional function called with each new checkpoint (see parser),
+        once every event before it has been yielded
+    resume - checkpoint from an earlier parse of the file, from whose byte_offset to carry on
+    multidoc - if True, the file holds any number of documents, one after another, e.g. a log,
+        each followed by an (end_document,) event (see parser)
+    '''
+    start = resume.byte_offset if resume is not None else 0
+    yield from iterparse(mapped_chunks(path, chunksize, start), encoding=encoding, lazy=lazy,
+                            on_checkpoint=on_checkpoint, resume=resume, multidoc=multidoc)
+
+
+def parse(text, encoding=None):
+    yield from iterparse(text, encoding=encoding)
+
+
+def parsefrags(textfrags, encoding=None):
+    yield from iterparse(textfrags, encoding=encoding)
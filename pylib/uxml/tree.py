@@ -7,20 +7,34 @@
 
 # See also: http://www.w3.org/community/microxml/wiki/MicroLarkApi
 
+import io
+import re
 import sys
+import mmap
+import codecs
 import weakref
+import operator
+from types import MappingProxyType
 from xml.sax.saxutils import escape, quoteattr
 
-from amara3.uxml.parser import parser, event  # parse, parsefrags
+from amara3.uxml.parser import parser, mapped_chunks, sniff_encoding, event, START_ELEMENT, END_ELEMENT, CHARACTERS  # parse, parsefrags
 
 # NO_PARENT = object()
 
+#Shared by all elements without attributes, rather than each having its own empty dict.
+#Read-only, so to add attributes to such an element, assign it a new dict
+EMPTY_ATTRIBUTES = MappingProxyType({})
+
 
 class node:
+    #No instance dict, so that subclasses can be made compact with __slots__.
+    #Subclasses not declaring __slots__, e.g. text, still get one
+    __slots__ = ()
+    xml_name = '' # to be overridden
+
     def __init__(self, parent=None):
         self._xml_parent = weakref.ref(parent) if parent is not None else None
         # self._xml_parent = weakref.ref(parent or NO_PARENT)
-        self.xml_name = '' # to be overridden
 
     @property
     def xml_parent(self):
@@ -28,11 +42,47 @@ class node:
         # p = self._xml_parent()
         # return None if p is NO_PARENT else p
 
+    def _xml_extra_state(self, standard):
+        #Any attributes beyond those in standard, e.g. from subclasses, for pickling
+        extra = { k: v for k, v in getattr(self, '__dict__', {}).items() if k not in standard }
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in standard and hasattr(self, name):
+                    extra[name] = getattr(self, name)
+        return extra or None
+
     def xml_encode(self):
         raise NotImplementedError
 
-    def xml_write(self, fp=sys.stdout):
-        fp.write(self.xml_encode())
+    def xml_write(self, fp=sys.stdout, indent=None, encoding='utf-8', bufsize=1<<16):
+        '''
+        Write the XML text of this node to a file, a buffer at a time, so that the
+        whole text is never in memory at once, however large the tree
+
+        fp - file object. Anything other than a text file (io.TextIOBase) is written bytes
+        indent - as with xml_encode
+        encoding - encoding of the output to a binary file. Characters it can't represent are written as character references
+        bufsize - number of characters gathered before each write
+        '''
+        binary = not isinstance(fp, io.TextIOBase)
+        if isinstance(self, element) and type(self).xml_encode is not element.xml_encode:
+            #Respect any serialization of a subclass's own, as _xml_pieces does for descendants
+            pieces = (self.xml_encode(indent=indent),)
+        else:
+            pieces = _xml_pieces(self, indent)
+        buf = []
+        size = 0
+        for piece in pieces:
+            buf.append(piece)
+            size += len(piece)
+            if size >= bufsize:
+                chunk = ''.join(buf)
+                fp.write(chunk.encode(encoding, 'uxmlcharrefreplace') if binary else chunk)
+                buf = []
+                size = 0
+        if buf:
+            chunk = ''.join(buf)
+            fp.write(chunk.encode(encoding, 'uxmlcharrefreplace') if binary else chunk)
 
     def xml_xpath(self, xpath, vars=None, funcs=None):
         '''
@@ -67,14 +117,62 @@ class node:
 class element(node):
     '''
     Note: Meant to be bare bones & Pythonic. Does no integrity checking of direct manipulations, such as adding an integer to xml_children, or '1' as an attribute name
+
+    Elements created without attrs (None) share the read-only EMPTY_ATTRIBUTES, so to add attributes to one, assign
+    it a new dict. A dict passed in, even an empty one, is kept as is. The children list is only created when first needed
+
+    Set xml_cache_value to True, on this class or a subclass, to keep each element's xml_value once computed.
+    The cache is cleared for an element and its ancestors by xml_insert, xml_append, xml_remove and
+    assigning xml_children, but not by changing the xml_children list directly. Only changes to elements
+    with xml_cache_value set clear it, so set it for the classes of all elements of a tree
     '''
+    #_docorder is set by the uxpath engine
+    __slots__ = ('_xml_parent', 'xml_name', 'xml_attributes', '_xml_children', '_xml_value_cache', '_docorder', '__weakref__')
+
+    xml_cache_value = False
+
     def __init__(self, name, attrs=None, parent=None):#, ancestors=None):
-        node.__init__(self, parent)
+        self._xml_parent = weakref.ref(parent) if parent is not None else None
         self.xml_name = name
-        self.xml_attributes = attrs or {}
-        self.xml_children = []
+        self.xml_attributes = EMPTY_ATTRIBUTES if attrs is None else attrs
+        self._xml_children = None
+        self._xml_value_cache = None
         return
 
+    @property
+    def xml_children(self):
+        children = self._xml_children
+        if children is None:
+            children = self._xml_children = []
+        return children
+
+    @xml_children.setter
+    def xml_children(self, children):
+        idx = self._xml_changed()
+        if idx is not None:
+            for child in self._xml_children or (): idx._remove(child)
+        self._xml_children = children
+        if hasattr(self, '_docorder'):
+            for child in children: _label_inserted(self, child)
+        else:
+            for child in children: _unlabel(child)
+        if idx is not None:
+            for child in children: idx._add(child)
+
+    def _xml_changed(self):
+        #Clear any cached xml_value up the tree after a change to this element's children, returning the
+        #docindex of the document, if any. Neither need the ancestors, so without them a change stays O(1)
+        if not (self.xml_cache_value or _DOCINDEXES): return None
+        return _docindex_of(self._xml_invalidate())
+
+    def _xml_invalidate(self):
+        #Clear the cached xml_value of this element and its ancestors, returning the root of the tree
+        elem = self
+        while elem is not None:
+            elem._xml_value_cache = None
+            top, elem = elem, elem.xml_parent
+        return top
+
     def xml_encode(self, indent=None, depth=0):
         '''
         Unparse an object back to XML text, returning the string object
@@ -84,25 +182,7 @@ class element(node):
         >>> e.xml_encode()
         '<a>bc&amp;de</a>'
         '''
-        strbits = ['<', self.xml_name]
-        for aname, aval in self.xml_attributes.items():
-            strbits.extend([' ', aname, '=', quoteattr(aval)])
-        strbits.append('>')
-        if indent:
-            strbits.append('\n')
-            strbits.append(indent*depth)
-        for child in self.xml_children:
-            if isinstance(child, element):
-                strbits.append(child.xml_encode(indent=indent, depth=depth+1))
-                if indent:
-                    strbits.append('\n')
-                    strbits.append(indent*depth)
-            elif isinstance(child, str):
-                strbits.append(escape(child))
-            else:
-                strbits.append(child.xml_encode())
-        strbits.extend(['</', self.xml_name, '>'])
-        return ''.join(strbits)
+        return ''.join(_xml_pieces(self, indent, depth))
 
     # What's the difference from strval?
     @property
@@ -110,8 +190,12 @@ class element(node):
         '''
         Accumulated text in all descendant elements (similar to XPath text value)
         '''
-        # Recursive action
-        return ''.join(map(lambda x: x.xml_value, self.xml_children))
+        value = self._xml_value_cache
+        if value is None:
+            # Recursive action
+            value = ''.join(map(lambda x: x.xml_value, self._xml_children or ()))
+            if self.xml_cache_value: self._xml_value_cache = value
+        return value
 
     #Really just an alias that forbids specifying position
     def xml_append(self, child):
@@ -137,6 +221,16 @@ class element(node):
             self.xml_children.append(child)
         else:
             self.xml_children.insert(index, child)
+        if hasattr(self, '_docorder'):
+            _label_inserted(self, child)
+        else:
+            #Any labels from another document would be out of order in this one
+            _unlabel(child)
+        idx = self._xml_changed()
+        if idx is not None:
+            #Any index the child had as a root no longer applies
+            _DOCINDEXES.pop(child, None)
+            idx._add(child)
         return
 
     def xml_remove(self, child: node):
@@ -146,29 +240,43 @@ class element(node):
 
         child - the child to remove
         '''
-        if child in self.xml_children:
+        if child in (self._xml_children or ()):
             child._xml_parent = None
             self.xml_children.remove(child)
+            _unlabel(child)
+            idx = self._xml_changed()
+            if idx is not None: idx._remove(child)
         else:
             raise ValueError(f'Element {self} has no child {child}')
         return
 
+    def __reduce__(self):
+        #Weak refs can't be pickled. A pickled element becomes a root, unless restored along with its parent.
+        #Plain tuples rather than state dicts, which make pickling a large tree several times slower
+        return (_restore_element, (self.__class__, self.xml_name, dict(self.xml_attributes), self._xml_children,
+                    self._xml_extra_state(_ELEMENT_STATE)))
+
     def __repr__(self):
-        return u'{{uxml.element ({0}) "{1}" with {2} children}}'.format(hash(self), self.xml_name, len(self.xml_children))
+        return u'{{uxml.element ({0}) "{1}" with {2} children}}'.format(hash(self), self.xml_name, len(self._xml_children or ()))
 
     #def unparse(self):
     #    return '<' + self.name.encode('utf-8') + unparse_attrmap(self.attrmap) + '>'
 
 class text(node, str):
+    #str subclasses can't have __slots__ for the parent, so text nodes keep an instance dict
+    xml_name = '#text'
+
     def __new__(cls, value, parent=None):
         self = super(text, cls).__new__(cls, value)
         return self
 
     def __init__(self, value, parent=None):#, ancestors=None):
         node.__init__(self, parent)
-        self.xml_name = '#text'
         return
 
+    def __reduce__(self):
+        return (_restore_text, (self.__class__, str(self), self._xml_extra_state(_TEXT_STATE)))
+
     def __repr__(self):
         return u'{{uxml.text "{}"...}}'.format(str(self)[:10])
 
@@ -187,12 +295,332 @@ class text(node, str):
     #    return '<' + self.name.encode('utf-8') + unparse_attrmap(self.attrmap) + '>'
 
 
+_ELEMENT_STATE = frozenset(('_xml_parent', 'xml_name', 'xml_attributes', '_xml_children', '_xml_value_cache', '_docorder', '__weakref__'))
+_TEXT_STATE = frozenset(('_xml_parent', '_docorder'))
+
+
+def _restore_element(cls, name, attrs, children, extra):
+    '''
+    Recreate a pickled element, bypassing the initializer, whose signature differs in some subclasses
+    '''
+    elem = cls.__new__(cls)
+    elem._xml_parent = None
+    elem.xml_name = name
+    elem.xml_attributes = attrs or EMPTY_ATTRIBUTES
+    elem._xml_children = children or None
+    elem._xml_value_cache = None
+    if extra:
+        for k, v in extra.items():
+            setattr(elem, k, v)
+    if children:
+        ref = weakref.ref(elem)
+        for child in children:
+            child._xml_parent = ref
+    return elem
+
+
+def _restore_text(cls, value, extra):
+    t = str.__new__(cls, value)
+    t._xml_parent = None
+    if extra:
+        for k, v in extra.items():
+            setattr(t, k, v)
+    return t
+
+
+#Spacing of new document order labels, leaving room for labels of nodes inserted between them
+DOCORDER_GAP = 1 << 16
+
+_docorder_key = operator.attrgetter('_docorder')
+
+
+def _subtree(top):
+    #All nodes of the tree at top, in document order
+    nodes = []
+    stack = [top]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        children = getattr(node, '_xml_children', None)
+        if children: stack.extend(reversed(children))
+    return nodes
+
+
+def label_docorder(node):
+    '''
+    Label all nodes in the document of node, in the _docorder attribute, with numbers
+    in document order, spaced DOCORDER_GAP apart.
+
+    From then on the labels are maintained by xml_insert, xml_append and assigning
+    xml_children, usually by labeling just the new nodes within the gap where they are
+    inserted, otherwise by spacing out the labels of the smallest enclosing subtree with room.
+    Direct changes to xml_children lists aren't tracked.
+    Labels are dropped from nodes removed with xml_remove, or inserted into an unlabeled document,
+    so that their new document is labeled afresh when next compared
+    '''
+    parent = node.xml_parent
+    while parent is not None:
+        node, parent = parent, parent.xml_parent
+    label = 0
+    for n in _subtree(node):
+        n._docorder = label
+        label += DOCORDER_GAP
+
+
+def _unlabel(top):
+    #Drop the labels of the tree at top, if it has any
+    if not hasattr(top, '_docorder'): return
+    for n in _subtree(top):
+        try:
+            del n._docorder
+        except AttributeError:
+            pass
+
+
+def compare_docorder(a, b):
+    '''
+    Compare the positions of two nodes of the same document in constant time,
+    returning -1 if a comes before b in document order, 1 if after and 0 if the same.
+    Labels the document first if need be
+    '''
+    try:
+        la, lb = a._docorder, b._docorder
+    except AttributeError:
+        label_docorder(a)
+        la, lb = a._docorder, b._docorder
+    return (la > lb) - (la < lb)
+
+
+def _position(siblings, node):
+    #Index by identity, since text nodes equal to their siblings might come first
+    for i, sibling in enumerate(siblings):
+        if sibling is node: return i
+    raise ValueError(node)
+
+
+def _next_label(node):
+    #Label of the first node after node's subtree in document order, or None at the end of the document
+    parent = node.xml_parent
+    while parent is not None:
+        siblings = parent._xml_children
+        i = _position(siblings, node)
+        if i + 1 < len(siblings): return siblings[i+1]._docorder
+        node, parent = parent, parent.xml_parent
+    return None
+
+
+def _spread_labels(nodes, lower, upper):
+    #Label nodes evenly between lower and upper (exclusive, None for no bound), if there's room
+    if upper is None:
+        step = DOCORDER_GAP
+    else:
+        step = (upper - lower) // (len(nodes) + 1)
+        if step < 1: return False
+    label = lower
+    for n in nodes:
+        label += step
+        n._docorder = label
+    return True
+
+
+def _label_inserted(parent, child):
+    #Label the subtree at child, just inserted into parent, which is in a labeled document
+    try:
+        _label_subtree(parent, child)
+    except AttributeError:
+        #Some nodes are unlabeled, having been added to xml_children directly
+        label_docorder(parent)
+
+
+def _label_subtree(parent, child):
+    siblings = parent._xml_children
+    i = _position(siblings, child)
+    if i:
+        #The last node in the preceding sibling's subtree
+        prev = siblings[i-1]
+        while getattr(prev, '_xml_children', None):
+            prev = prev._xml_children[-1]
+        lower = prev._docorder
+    else:
+        lower = parent._docorder
+    if _spread_labels(_subtree(child), lower, _next_label(child)): return
+    #No room, so space out the labels of the smallest enclosing subtree that has some
+    top = parent
+    while not _spread_labels(_subtree(top)[1:], top._docorder, _next_label(top)):
+        top = top.xml_parent
+
+
+#Indexes of documents, by document element
+_DOCINDEXES = weakref.WeakKeyDictionary()
+
+
+def _docindex_of(top):
+    return _DOCINDEXES.get(top) if _DOCINDEXES else None
+
+
+class docindex(object):
+    '''
+    Index of the elements of a document by name, and by attribute name and value, so that
+    they can be looked up in time proportional to the number of results rather than the
+    size of the document. Results are in document order.
+
+    Once made, a document's index is kept up to date by xml_insert, xml_append, xml_remove
+    and assigning xml_children, but not by changing xml_children lists or xml_attributes
+    directly. It's also used by uxpath for expressions of the forms //name, //@attr,
+    //name[@attr="value"], //*[@attr="value"] and //@attr[.="value"]
+
+    >>> from amara3.uxml.tree import parse, docindex
+    >>> root = parse('<a><b id="1">x</b><c><b id="2">y</b></c></a>')
+    >>> idx = docindex(root)
+    >>> [ e.xml_value for e in idx.elements('b') ]
+    ['x', 'y']
+    >>> [ e.xml_value for e in idx.attribute('id', '2') ]
+    ['y']
+    '''
+    def __init__(self, root):
+        '''
+        root - document element, which must have no parent
+        '''
+        #Weak, since the index is kept for as long as the root
+        self._root = weakref.ref(root)
+        self._names = {}
+        self._attr_names = {}
+        self._attr_values = {}
+        #Lists with elements out of document order, following an insertion, to be sorted when next needed
+        self._unsorted = set()
+        self._add(root)
+        self._unsorted.clear()
+        _DOCINDEXES[root] = self
+
+    @staticmethod
+    def get(node):
+        '''
+        Index of the document to which node belongs, or None
+        '''
+        if not _DOCINDEXES: return None
+        parent = node.xml_parent
+        while parent is not None:
+            node, parent = parent, parent.xml_parent
+        return _DOCINDEXES.get(node)
+
+    def _add(self, top):
+        if not isinstance(top, element): return
+        unsorted = self._unsorted
+        stack = [top]
+        while stack:
+            elem = stack.pop()
+            self._names.setdefault(elem.xml_name, {})[elem] = None
+            unsorted.add(('_names', elem.xml_name))
+            for aname, aval in elem.xml_attributes.items():
+                self._attr_names.setdefault(aname, {})[elem] = None
+                self._attr_values.setdefault((aname, aval), {})[elem] = None
+                unsorted.add(('_attr_names', aname))
+                unsorted.add(('_attr_values', (aname, aval)))
+            stack.extend(reversed([ child for child in elem._xml_children or () if isinstance(child, element) ]))
+
+    def _remove(self, top):
+        if not isinstance(top, element): return
+        stack = [top]
+        while stack:
+            elem = stack.pop()
+            self._names[elem.xml_name].pop(elem, None)
+            for aname, aval in elem.xml_attributes.items():
+                self._attr_names[aname].pop(elem, None)
+                self._attr_values[(aname, aval)].pop(elem, None)
+            stack.extend( child for child in elem._xml_children or () if isinstance(child, element) )
+
+    def _lookup(self, table, key):
+        #table - name of the attribute holding the table
+        if (table, key) in self._unsorted: self._sort()
+        return list(getattr(self, table).get(key, ()))
+
+    def _sort(self):
+        #Put all lists changed by insertions back in document order. Labels are maintained
+        #through insertions, so the document need only be labeled once
+        root = self._root()
+        if not hasattr(root, '_docorder'): label_docorder(root)
+        for table, key in self._unsorted:
+            table = getattr(self, table)
+            if key in table:
+                table[key] = dict.fromkeys(sorted(table[key], key=_docorder_key))
+        self._unsorted.clear()
+
+    def elements(self, name):
+        '''
+        List of the elements of the given name
+        '''
+        return self._lookup('_names', name)
+
+    def attribute(self, name, value=None):
+        '''
+        List of the elements with an attribute of the given name and, unless None, value
+        '''
+        if value is None:
+            return self._lookup('_attr_names', name)
+        return self._lookup('_attr_values', (name, value))
+
+
+def _start_tag(elem):
+    attrs = elem.xml_attributes
+    if not attrs: return '<' + elem.xml_name + '>'
+    strbits = ['<', elem.xml_name]
+    for aname, aval in attrs.items():
+        strbits.extend([' ', aname, '=', quoteattr(aval)])
+    strbits.append('>')
+    return ''.join(strbits)
+
+
+def _xml_pieces(top, indent=None, depth=0):
+    '''
+    Yield the XML text of the tree at top in pieces, in order. Uses a stack
+    rather than recursion, so deep trees can't exceed the recursion limit
+    '''
+    if not isinstance(top, element):
+        yield top.xml_encode()
+        return
+    yield _start_tag(top)
+    if indent: yield '\n' + indent*depth
+    plain_encode = element.xml_encode
+    stack = [(top, depth, iter(top._xml_children or ()))]
+    while stack:
+        elem, depth, children = stack[-1]
+        for child in children:
+            if isinstance(child, element):
+                #Respect any serialization of a subclass's own
+                if type(child).xml_encode is not plain_encode:
+                    yield child.xml_encode(indent=indent, depth=depth+1)
+                    if indent: yield '\n' + indent*depth
+                    continue
+                yield _start_tag(child)
+                if indent: yield '\n' + indent*(depth+1)
+                stack.append((child, depth+1, iter(child._xml_children or ())))
+                break
+            elif isinstance(child, str):
+                yield escape(child)
+            else:
+                yield child.xml_encode()
+        else:
+            stack.pop()
+            yield '</' + elem.xml_name + '>'
+            if indent and stack: yield '\n' + indent*stack[-1][1]
+
+
+def _uxmlcharrefreplace(exc):
+    #As the standard xmlcharrefreplace, but in hex, the only form of character reference in MicroXML
+    return (''.join( '&#x{0:X};'.format(ord(c)) for c in exc.object[exc.start:exc.end] ), exc.end)
+
+
+codecs.register_error('uxmlcharrefreplace', _uxmlcharrefreplace)
+
+
 def strval(node, outermost=True):
     '''
     XPath-like string value of node
     '''
     if not isinstance(node, element):
         return node.xml_value if outermost else [node.xml_value]
+    #The same for an element, and possibly cached
+    if outermost: return node.xml_value
     accumulator = []
     for child in node.xml_children:
         if isinstance(child, text):
@@ -203,55 +631,253 @@ def strval(node, outermost=True):
     return accumulator
 
 
+class lazy_element(element):
+    '''
+    Element built by a lazy parse (e.g. parse(doc, lazy=True)), which keeps the source range of its content
+    and only parses it into children the first time they're needed. The document source is held
+    until every element of it has been materialized or collected
+
+    Errors in an element's content are only reported then, as RuntimeError from the parser
+    '''
+    __slots__ = ('_xml_source',)
+
+    def __init__(self, name, attrs=None, parent=None):
+        #Before element.__init__, whose assignment of _xml_children goes through the property below
+        self._xml_source = None
+        element.__init__(self, name, attrs, parent)
+
+    @property
+    def _xml_children(self):
+        source = self._xml_source
+        if source is not None:
+            self._xml_source = None
+            _CHILDREN_SLOT.__set__(self, _lazy_children(self, *source) or None)
+        return _CHILDREN_SLOT.__get__(self)
+
+    @_xml_children.setter
+    def _xml_children(self, children):
+        self._xml_source = None
+        _CHILDREN_SLOT.__set__(self, children)
+
+    def __reduce__(self):
+        #Pickles as a plain tree, rather than holding on to the source
+        return (_restore_element, (element, self.xml_name, dict(self.xml_attributes), self._xml_children, None))
+
+
+#Storage of element._xml_children, which lazy_element hides behind a property
+_CHILDREN_SLOT = element.__dict__['_xml_children']
+
+#Tags, with group 1 set for end tags and 2 for empty element tags. '<' can't occur in content except
+#as markup, so tags can be found without parsing. Quoted attribute values are passed over whole,
+#since the parser lets '<' and '>' by in them. Space is allowed wherever the parser allows it
+_LAZY_TAG_PAT = r'<[ \t\n\r]*(/)?(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/)?>'
+_LAZY_TAG = re.compile(_LAZY_TAG_PAT)
+_LAZY_TAG_BYTES = re.compile(_LAZY_TAG_PAT.encode('ascii'))
+_LAZY_END_TAG = re.compile(r'<[ \t\n\r]*/')
+_LAZY_END_TAG_BYTES = re.compile(rb'<[ \t\n\r]*/')
+
+
+def _scan_children(src, start, end):
+    '''
+    Skeleton scan of element content src[start:end], counting tags without parsing them.
+    Return a list of (start tag start, start tag end, content end, end tag end) for each child element
+    '''
+    tag = _LAZY_TAG if isinstance(src, str) else _LAZY_TAG_BYTES
+    spans = []
+    depth = 0
+    for m in tag.finditer(src, start, end):
+        kind = m.lastindex
+        if kind is None:
+            if not depth: spans.append([m.start(), m.end(), None, None])
+            depth += 1
+        elif kind == 1:
+            depth -= 1
+            if not depth:
+                spans[-1][2:] = m.span()
+            elif depth < 0:
+                raise RuntimeError('Unexpected end tag in element content (at offset {0})'.format(m.start()))
+        else:
+            if not depth: spans.append([m.start(), m.end(), m.end(), m.end()])
+    if depth:
+        raise RuntimeError('Unclosed element in element content (at offset {0})'.format(spans[-1][0]))
+    return spans
+
+
+def _lazy_parse(shallow, level, parent, spans, src):
+    '''
+    Parse MicroXML text in which elements have had their content cut out, returning the elements
+    at depth level, as lazy_element, with the source ranges of their content, and any text beside them
+
+    spans - (content start, content end) in src of each of those elements, in order
+    '''
+    nodes = []
+    def handler():
+        depth = 0
+        spans_iter = iter(spans)
+        while True:
+            for ev in (yield):
+                if ev[0] == START_ELEMENT:
+                    depth += 1
+                    if depth == level:
+                        child = lazy_element(ev[1], ev[2] or None, parent)
+                        content_start, content_end = next(spans_iter)
+                        if content_end > content_start: child._xml_source = (src, content_start, content_end)
+                        nodes.append(child)
+                elif ev[0] == CHARACTERS:
+                    #Text outside the document element is dropped, as with treebuilder
+                    if depth == level - 1 and parent is not None: nodes.append(text(ev[1], parent))
+                elif ev[0] == END_ELEMENT:
+                    depth -= 1
+    p = parser(handler(), batch=True)
+    p.send((shallow, False))
+    p.send((shallow[:0], True)) #Wrap it up
+    return nodes
+
+
+def _lazy_children(elem, src, start, end):
+    #Parse the children of elem from its content src[start:end], in a wrapper element, leaving out their own content
+    spans = _scan_children(src, start, end)
+    if isinstance(src, str):
+        pieces = ['<_>']
+        close = '</_>'
+    else:
+        pieces = [b'<_>']
+        close = b'</_>'
+    prev = start
+    for tag_start, tag_end, content_end, close_end in spans:
+        pieces.append(src[prev:tag_end])
+        pieces.append(src[content_end:close_end])
+        prev = close_end
+    pieces.append(src[prev:end])
+    pieces.append(close)
+    return _lazy_parse(pieces[0][:0].join(pieces), 2, elem, [ (s[1], s[2]) for s in spans ], src)
+
+
+def _lazy_root(src):
+    '''
+    Return the document element of MicroXML in src, as lazy_element, or None if it can't be found
+    without a full parse (e.g. an empty element tag), in which case the document should be parsed as usual
+
+    src - str, or bytes-like object (e.g. mmap) in UTF-8
+    '''
+    is_str = isinstance(src, str)
+    tag = _LAZY_TAG if is_str else _LAZY_TAG_BYTES
+    start_tag = tag.search(src)
+    if start_tag is None or start_tag.group(1) or start_tag.group(2): return None
+    #The end tag of the document element is the last tag, after which there can only be space
+    end_tag = src.rfind('<' if is_str else b'<')
+    end_tag_pat = _LAZY_END_TAG if is_str else _LAZY_END_TAG_BYTES
+    if end_tag < start_tag.end() or not end_tag_pat.match(src, end_tag): return None
+    shallow = src[:start_tag.end()] + src[end_tag:]
+    return _lazy_parse(shallow, 1, None, [(start_tag.end(), end_tag)], src)[0]
+
+
 class treebuilder(object):
-    def __init__(self):
+    def __init__(self, index=False, lazy=False):
+        '''
+        index - if True, make a docindex of each document built
+        lazy - if True, build MicroXML documents from lazy_element, whose children are only parsed when
+            first needed, after a skeleton scan of their parent's content for the extent of each.
+            Only the document element is built up front. Indexing needs every element, so defeats this
+        '''
         self._root = None
         self._parent = None
+        self._index = index
+        self._lazy = lazy
 
     def _handler(self):
         while True:
-            ev = yield
-            if ev[0] == event.start_element:
-                new_element = element(ev[1], ev[2], self._parent)
-                #Note: not using weakrefs here because these refs are not circular
-                if self._parent: self._parent.xml_children.append(new_element)
-                self._parent = new_element
-                #Hold a reference to the top element of the subtree being built,
-                #or it will be garbage collected as the builder moves down the tree
-                if not self._root: self._root = new_element
-            elif ev[0] == event.characters:
-                new_text = text(ev[1], self._parent)
-                if self._parent: self._parent.xml_children.append(new_text)
-            elif ev[0] == event.end_element:
-                if self._parent:
-                    self._parent = self._parent.xml_parent
+            evs = yield
+            #A list is a batch of events from a parser in batch mode. Otherwise it's a single event
+            if not isinstance(evs, list): evs = (evs,)
+            for ev in evs:
+                if ev[0] == START_ELEMENT:
+                    #Elements without attributes share EMPTY_ATTRIBUTES rather than each keeping the parser's empty dict
+                    new_element = element(ev[1], ev[2] or None, self._parent)
+                    #Note: not using weakrefs here because these refs are not circular
+                    if self._parent: self._parent.xml_children.append(new_element)
+                    self._parent = new_element
+                    #Hold a reference to the top element of the subtree being built,
+                    #or it will be garbage collected as the builder moves down the tree
+                    if not self._root: self._root = new_element
+                elif ev[0] == CHARACTERS:
+                    new_text = text(ev[1], self._parent)
+                    if self._parent: self._parent.xml_children.append(new_text)
+                elif ev[0] == END_ELEMENT:
+                    if self._parent:
+                        self._parent = self._parent.xml_parent
         return
 
     def parse(self, doc):
+        if self._lazy:
+            #Lazy parsing scans the source for tags, so it must be str, or bytes in UTF-8
+            if not isinstance(doc, str) and sniff_encoding(doc[:4]) not in ('utf-8', 'utf-8-sig'):
+                doc = str(doc, sniff_encoding(doc[:4]))
+            root = _lazy_root(doc)
+            if root is not None:
+                if self._index: docindex(root)
+                return root
         #reset
         self._root = None
         self._parent = None
         h = self._handler()
-        p = parser(h)
+        p = parser(h, batch=True)
         p.send((doc, False))
         p.send(('', True)) #Wrap it up
+        if self._index: docindex(self._root)
+        return self._root
+
+    def parse_file(self, path, encoding=None):
+        '''
+        Parse the MicroXML file at path, which is memory mapped and fed to the parser
+        a chunk at a time, rather than being read into memory whole
+
+        encoding - encoding of the file. If None, sniffed from the first few bytes
+
+        In lazy mode a file in UTF-8 is parsed from the memory mapping as needed, and kept mapped
+        until every element of it has been materialized or collected. Other encodings are decoded whole
+        '''
+        if self._lazy:
+            with open(path, 'rb') as fp:
+                try:
+                    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    mm = b'' #Empty files can't be mapped. Reported by the parser below
+            if encoding is None: encoding = sniff_encoding(mm[:4])
+            root = _lazy_root(mm if encoding in ('utf-8', 'utf-8-sig') else str(mm, encoding))
+            if root is not None:
+                if self._index: docindex(root)
+                return root
+        #reset
+        self._root = None
+        self._parent = None
+        h = self._handler()
+        p = parser(h, encoding=encoding, batch=True)
+        for chunk in mapped_chunks(path):
+            p.send((chunk, False))
+        p.send(('', True)) #Wrap it up
+        if self._index: docindex(self._root)
         return self._root
 
 
 def name_test(name):
     def _name_test(ev):
-        return ev[0] == event.start_element and ev[1] == name
+        return ev[0] == START_ELEMENT and ev[1] == name
     return _name_test
 
 
 def elem_test():
     def _elem_test(ev):
-        return ev[0] == event.start_element
+        return ev[0] == START_ELEMENT
     return _elem_test
 
 
-def parse(doc):
-    return treebuilder().parse(doc)
+def parse(doc, index=False, lazy=False):
+    return treebuilder(index=index, lazy=lazy).parse(doc)
+
+
+def parse_file(path, encoding=None, index=False, lazy=False):
+    return treebuilder(index=index, lazy=lazy).parse_file(path, encoding=encoding)
 
 
 '''
@@ -7,7 +7,7 @@
 
 from collections.abc import Iterable
 
-from .parser import parser, event  # parsefrags
+from .parser import parser, event, START_ELEMENT, END_ELEMENT, CHARACTERS, SKIP  # parsefrags
 from .tree import element, text, name_test
 
 
@@ -53,7 +53,7 @@ class sender:
         self._roots = [None] * self._pattern_count
         self._parents = [None] * self._pattern_count
         self._stateses = [None] * self._pattern_count
-        self._evstacks = [[]] * self._pattern_count
+        self._evstacks = [[] for ix in range(self._pattern_count)]
         self._building_depths = [0] * self._pattern_count
         # if asyncio.iscoroutine(sink):
         if prime_sinks:
@@ -65,19 +65,19 @@ class sender:
 
     def _only_name(self, next, name):
         def _only_name_func(ev):
-            if ev[0] == event.start_element and ev[1] == name:
+            if ev[0] == START_ELEMENT and ev[1] == name:
                 return next
         return _only_name_func
 
     def _any_name(self, next):
         def _any_name_func(ev):
-            if ev[0] == event.start_element:
+            if ev[0] == START_ELEMENT:
                 return next
         return _any_name_func
 
     def _any_until(self, next):
         def _any_until_func(ev):
-            if ev[0] == event.start_element:
+            if ev[0] == START_ELEMENT:
                 next_next = next(ev)
                 if next_next is not None:
                     return next_next
@@ -91,8 +91,8 @@ class sender:
         return _any_func
 
     def _prep_patterns(self):
-        next_state = MATCHED_STATE
         for ix, pattern in enumerate(self._patterns):
+            next_state = MATCHED_STATE
             for i in range(len(pattern)):
                 stage = pattern[-i-1]
                 if isinstance(stage, str):
@@ -111,60 +111,90 @@ class sender:
         return
 
     def _match_state(self, ix):
+        '''
+        True if the current element matches pattern ix, None if neither it nor
+        any of its descendants can, otherwise False
+        '''
         new_state = self._stateses[ix]
         for depth, ev in enumerate(self._evstacks[ix]):
             new_state = new_state(ev)
             if new_state == MATCHED_STATE:
                 return True
             elif new_state is None:
-                return False
+                return None
         return False
 
     def _handler(self):
+        result = None
         while True:
-            ev = yield
-            for ix, evstack in enumerate(self._evstacks):
-                building_depth = self._building_depths[ix]
-                parent = self._parents[ix]
-                if ev[0] == event.start_element:
-                    evstack.append(ev)
-                    #Keep track of the depth while we're building elements. When we ge back to 0 depth, we're done for this subtree
-                    if building_depth:
-                        building_depth += 1
-                        self._building_depths[ix] = building_depth
-                    elif self._match_state(ix):
-                        building_depth = self._building_depths[ix] = 1
-                    if building_depth:
-                        new_element = element(ev[1], ev[2], parent)
-                        #if parent: parent().xml_children.append(weakref.ref(new_element))
-                        #Note: not using weakrefs here because these refs are not circular
-                        if parent: parent.xml_children.append(new_element)
-                        parent = self._parents[ix] = new_element
-                        #Hold a reference to the top element of the subtree being built,
-                        #or it will be garbage collected as the builder moves down the tree
-                        if building_depth == 1: self._roots[ix] = new_element
-                elif ev[0] == event.characters:
-                    if building_depth:
-                        new_text = text(ev[1], parent)
-                        if parent: parent.xml_children.append(new_text)
-                elif ev[0] == event.end_element:
-                    evstack.pop()
-                    if building_depth:
-                        building_depth -= 1
-                        self._building_depths[ix] = building_depth
-                        #Done with this subtree
-                        if not building_depth:
-                            self._sinks[ix].send(parent)
-                        #Pop back up in element ancestry
-                        if parent:
-                            parent = self._parents[ix] = parent.xml_parent
-
-                #print(ev, building_depth, evstack)
+            evs = yield result
+            #A list is a batch of events from a parser in batch mode. Otherwise it's a single event
+            if not isinstance(evs, list): evs = (evs,)
+            for ev in evs:
+                #Whether this element's subtree can be skipped, i.e. is not being built and can't match any pattern
+                dead = ev[0] == START_ELEMENT
+                for ix, evstack in enumerate(self._evstacks):
+                    building_depth = self._building_depths[ix]
+                    parent = self._parents[ix]
+                    if ev[0] == START_ELEMENT:
+                        evstack.append(ev)
+                        #Keep track of the depth while we're building elements. When we ge back to 0 depth, we're done for this subtree
+                        if building_depth:
+                            building_depth += 1
+                            self._building_depths[ix] = building_depth
+                            dead = False
+                        else:
+                            matched = self._match_state(ix)
+                            if matched:
+                                building_depth = self._building_depths[ix] = 1
+                            if matched is not None:
+                                dead = False
+                        if building_depth:
+                            #From the parser in lazy mode these are rawtext, so only values actually used are decoded
+                            attrs = { k: str(v) for k, v in ev[2].items() }
+                            new_element = element(ev[1], attrs or None, parent)
+                            #if parent: parent().xml_children.append(weakref.ref(new_element))
+                            #Note: not using weakrefs here because these refs are not circular
+                            if parent: parent.xml_children.append(new_element)
+                            parent = self._parents[ix] = new_element
+                            #Hold a reference to the top element of the subtree being built,
+                            #or it will be garbage collected as the builder moves down the tree
+                            if building_depth == 1: self._roots[ix] = new_element
+                    elif ev[0] == CHARACTERS:
+                        if building_depth:
+                            new_text = text(str(ev[1]), parent)
+                            if parent: parent.xml_children.append(new_text)
+                    elif ev[0] == END_ELEMENT:
+                        evstack.pop()
+                        if building_depth:
+                            building_depth -= 1
+                            self._building_depths[ix] = building_depth
+                            #Done with this subtree
+                            if not building_depth:
+                                self._sinks[ix].send(parent)
+                            #Pop back up in element ancestry
+                            if parent:
+                                parent = self._parents[ix] = parent.xml_parent
+
+                    #print(ev, building_depth, evstack)
+                result = SKIP if dead else None
         return
 
-    def parse(self, doc):
+    def parser(self, encoding=None, multidoc=False):
+        '''
+        Return a parser coroutine which feeds the sinks, to be sent (fragment, done) tuples
+        as input arrives, e.g. from a network connection
+
+        encoding - encoding of any bytes fragments. If None, sniffed from the first few bytes
+        multidoc - if True, accept a stream of any number of documents, one after another
+        '''
         h = self._handler()
-        p = parser(h)
+        #Not in batch mode, so that subtrees which can't match are skipped by the parser,
+        #and lazy, so that text outside the subtrees built is never decoded
+        return parser(h, encoding=encoding, lazy=True, multidoc=multidoc)
+
+    def parse(self, doc):
+        p = self.parser()
         p.send((doc, False))
         p.send(('', True))  # Wrap it up
         return
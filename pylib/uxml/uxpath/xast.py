@@ -24,10 +24,10 @@ __all__ = [
     ]
 
 
-import operator
+import functools
 # import functools
 from collections.abc import Iterable
-from amara3.uxml.tree import node, element, strval
+from amara3.uxml.tree import node, element, strval, docindex, label_docorder, compare_docorder
 from amara3.uxml.treeutil import descendants
 
 
@@ -37,6 +37,8 @@ class root_node(node):
     we need something to conform as closely as we can to XPath
     '''
     _cache = {}
+    #Before everything else in document order
+    _docorder = -1
 
     def __init__(self, docelem):
         self.xml_name = ''
@@ -71,6 +73,11 @@ class attribute_node(node):
     def __repr__(self):
         return '{{uxpath.attribute {0}="{1}"}}'.format(self.xml_name, self.xml_value)
 
+    @property
+    def _docorder(self):
+        #After the element, before its first child
+        return self.xml_parent._docorder + 0.5
+
     def xml_encode(self):
         return '{{{0}="{1}"}}'.format(self.xml_name, self.xml_value)
 
@@ -79,14 +86,8 @@ class attribute_node(node):
 
 
 def index_docorder(node):
-    #Always start at the root
-    while node.xml_parent:
-        node = node.xml_parent
-    index = 0
-    node._docorder = index
-    for node in descendants(node):
-        index += 1
-        node._docorder = index
+    #Now maintained by the tree, once labeled
+    label_docorder(node)
 
 
 # Casts
@@ -270,14 +271,22 @@ class binary_expression:
                 new_ctx = ctx.copy(item=item)
                 yield from self.right.compute(new_ctx)
         elif self.op == '|':
-            # Union expressions require an indexing by doc order
-            if not hasattr(ctx.item, '_docorder'):
-                index_docorder(ctx.item)
-            # XXX Might be more efficient to maintain a list in doc order as left & right are added
+            # Union expressions give nodes in doc order, without duplicates.
+            # Labels are maintained by the tree, so the document is only labeled once
             selected = list(self.left.compute(ctx))
             selected.extend(list(self.right.compute(ctx)))
-            selected.sort(key=operator.attrgetter('_docorder'))
-            yield from selected
+            selected.sort(key=functools.cmp_to_key(compare_docorder))
+            prev = None
+            for item in selected:
+                # Attributes of the same element share a position, and need not be next to each other
+                # in the sorted list, so check against every name in the run of that position
+                if prev is None or compare_docorder(item, prev) != 0:
+                    names = set()
+                elif item.xml_name in names:
+                    continue
+                names.add(item.xml_name)
+                yield item
+                prev = item
 
         # FIXME: A lot of work to do on comparisons
         elif self.op == '=':
@@ -371,6 +380,10 @@ class absolute_path:
             yield from self.relative.compute(new_ctx)
         # e.g. //*, or first part of //a/b/c
         elif self.op == '//':
+            found = _indexed_lookup(rnode, self.relative)
+            if found is not None:
+                yield from found
+                return
             if _step_is_just_node(self.relative):
                 yield rnode
             new_ctx = ctx.copy(item=rnode)
@@ -383,6 +396,51 @@ class absolute_path:
                 yield from self.relative.compute(new_ctx)
 
 
+def _indexed_lookup(rnode, relative, value=None):
+    '''
+    Results of //relative, if the document has a docindex and relative is a step of the form
+    name or @name, otherwise None. If value is given, only elements, or attributes, where the
+    attribute has that value
+    '''
+    if not (isinstance(relative, step) and isinstance(relative.node_test, name_test)):
+        return None
+    idx = docindex.get(rnode.xml_children[0]) if rnode.xml_children else None
+    if idx is None: return None
+    name = relative.node_test.name
+    if relative.axis == 'child' and name != '*' and value is None:
+        return idx.elements(name)
+    elif relative.axis == 'attribute' and name != '*':
+        return ( attribute_node(name, e.xml_attributes[name], e) for e in idx.attribute(name, value) )
+    return None
+
+
+def _indexed_predicate(rnode, lhs, predicates):
+    '''
+    Results of lhs[predicate], if the document has a docindex and this is of the form
+    //name[@attr="value"], //*[@attr="value"] or //@attr[.="value"], otherwise None
+    '''
+    if not (isinstance(lhs, absolute_path) and lhs.op == '//' and len(predicates) == 1):
+        return None
+    pred = predicates[0]
+    if not (isinstance(pred, binary_expression) and pred.op == '='
+            and isinstance(pred.right, literal_wrapper) and isinstance(pred.right.obj, str)):
+        return None
+    value = pred.right.obj
+    relative = lhs.relative
+    if not (isinstance(relative, step) and isinstance(relative.node_test, name_test)):
+        return None
+    if relative.axis == 'attribute' and isinstance(pred.left, abbreviated_step) and pred.left.abbr == '.':
+        return _indexed_lookup(rnode, relative, value)
+    if relative.axis == 'child' and isinstance(pred.left, step) and pred.left.axis == 'attribute' \
+            and isinstance(pred.left.node_test, name_test) and pred.left.node_test.name != '*':
+        idx = docindex.get(rnode.xml_children[0]) if rnode.xml_children else None
+        if idx is None: return None
+        name = relative.node_test.name
+        found = idx.attribute(pred.left.node_test.name, value)
+        return found if name == '*' else [ e for e in found if e.xml_name == name ]
+    return None
+
+
 def _step_is_just_node(r):
     return isinstance(r, step) \
         and isinstance(r.node_test, node_type_test) \
@@ -535,6 +593,11 @@ class predicated_expression:
 
     def compute(self, ctx):
         # print('predicated_expression', (self.lhs, self.predicates))
+        if isinstance(self.lhs, absolute_path):
+            found = _indexed_predicate(root_node.get(ctx.item), self.lhs, self.predicates)
+            if found is not None:
+                yield from found
+                return
         for pos, item in enumerate(self.lhs.compute(ctx)):
             # XPath is 1-indexed
             new_ctx = ctx.copy(item=item, pos=pos+1)
@@ -9,13 +9,20 @@ import xml.parsers.expat
 # from xml.sax.saxutils import escape  # also quoteattr?
 
 from . import tree
-from .parser import event  # parser, parsefrags
+from .parser import event, START_ELEMENT, END_ELEMENT, CHARACTERS, NO_ANCESTORS  # parser, parsefrags
 
 
 class expat_callbacks(object):
-    def __init__(self, handler, prime_handler=True):
+    def __init__(self, handler, prime_handler=True, symbols=None):
+        '''
+        handler - coroutine to which MicroXML events are sent
+        prime_handler - if True call next() on the handler to get it started
+        symbols - optional dict used as symbol table for interning local names,
+            as with amara3.uxml.parser.parser. By default a fresh one for these callbacks
+        '''
         self._handler = handler
-        self._elem_stack = []
+        self._ancestors = NO_ANCESTORS
+        self._symbols = {} if symbols is None else symbols
         # if asyncio.iscoroutine(handler):
         if prime_handler:
             next(handler)  # Prime coroutine
@@ -23,23 +30,27 @@ class expat_callbacks(object):
 
     def start_element(self, name, attrs):
         #print('Start element:', name, attrs)
+        intern = self._symbols.setdefault
         local = name.split()[-1]
+        local = intern(local, local)
         #print(attrs, name)
         new_attrs = {}
         for aname, aval in attrs.items():
-            new_attrs[aname.split()[-1]] = aval
-        self._handler.send((event.start_element, local, new_attrs, self._elem_stack.copy()))
-        self._elem_stack.append(local)
+            alocal = aname.split()[-1]
+            new_attrs[intern(alocal, alocal)] = aval
+        self._handler.send((START_ELEMENT, local, new_attrs, self._ancestors))
+        self._ancestors = self._ancestors.push(local)
 
     def end_element(self, name):
         #print('End element:', name)
         local = name.split()[1] if ' ' in name else name
-        self._elem_stack.pop()
-        self._handler.send((event.end_element, local, self._elem_stack.copy()))
+        local = self._symbols.setdefault(local, local)
+        self._ancestors = self._ancestors.parent
+        self._handler.send((END_ELEMENT, local, self._ancestors))
 
     def char_data(self, data):
         #print('Character data:', repr(data))
-        self._handler.send((event.characters, data))
+        self._handler.send((CHARACTERS, data))
 
     def start_namespace(self, prefix, ns):
         pass
@@ -126,5 +137,6 @@ class treebuilder(tree.treebuilder):
         self.expat_parser.StartNamespaceDeclHandler = self.handler.start_namespace
         self.expat_parser.EndNamespaceDeclHandler = self.handler.end_namespace
         self.expat_parser.Parse(source)
+        if self._index: tree.docindex(self._root)
         return self._root
 
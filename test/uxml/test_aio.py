@@ -0,0 +1,81 @@
+'''
+py.test test/uxml/test_aio.py
+'''
+
+import asyncio
+
+import pytest
+from amara3.uxml import aio
+from amara3.uxml.parser import parse
+
+
+DOC = '<feed><entry id="1">a&amp;b</entry><entry id="2"><x>c</x></entry><other>d</other></feed>'
+
+
+def reader(data, chunk=5):
+    #Must be called with a running loop
+    r = asyncio.StreamReader()
+    for i in range(0, len(data), chunk):
+        r.feed_data(data[i:i+chunk])
+    r.feed_eof()
+    return r
+
+
+async def fragments(frags):
+    for frag in frags:
+        await asyncio.sleep(0)
+        yield frag
+
+
+async def collect(aiter):
+    return [ item async for item in aiter ]
+
+
+def test_iterparse_reader():
+    async def main():
+        return await collect(aio.iterparse(reader(DOC.encode('utf-8')), chunksize=3))
+    assert asyncio.run(main()) == list(parse(DOC))
+
+
+def test_iterparse_async_iterable():
+    assert asyncio.run(collect(aio.iterparse(fragments(DOC)))) == list(parse(DOC))
+
+
+def test_iterparse_incomplete():
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(aio.iterparse(fragments(['<feed>', '<entry>']))))
+
+
+def test_iterparse_checkpoint_resume():
+    data = DOC.encode('utf-8')
+    saved = []
+    async def main():
+        events = []
+        def on_checkpoint(cp):
+            saved.append((cp, len(events)))
+        async for ev in aio.iterparse(reader(data), chunksize=4, on_checkpoint=on_checkpoint):
+            events.append(ev)
+        return events
+    events = asyncio.run(main())
+    assert events == list(parse(DOC)) and saved
+    cp, count = saved[len(saved)//2]
+    async def resume():
+        return await collect(aio.iterparse(reader(data[cp.byte_offset:]), resume=cp))
+    resumed = asyncio.run(resume())
+    assert events[:count] + resumed == events
+
+
+def test_itersubtrees_concurrent():
+    #Many streams parsed concurrently on one loop, with their input interleaved
+    async def main():
+        readers = [ reader(DOC.replace('"1"', '"{0}"'.format(i)).encode('utf-16'), chunk=7) for i in range(50) ]
+        return await asyncio.gather(*( collect(aio.itersubtrees(r, ('feed', 'entry'), chunksize=4)) for r in readers ))
+    for i, elems in enumerate(asyncio.run(main())):
+        assert [ e.xml_attributes['id'] for e in elems ] == [str(i), '2']
+        assert [ e.xml_value for e in elems ] == ['a&b', 'c']
+
+
+def test_itersubtrees_multidoc():
+    async def main():
+        return await collect(aio.itersubtrees(reader((DOC * 3).encode('utf-8')), ('feed', 'entry'), multidoc=True))
+    assert [ e.xml_attributes['id'] for e in asyncio.run(main()) ] == ['1', '2'] * 3
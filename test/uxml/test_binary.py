@@ -0,0 +1,150 @@
+'''
+py.test test/uxml/test_binary.py
+'''
+
+import io
+import pickle
+
+import pytest
+from amara3.uxml import tree, binary
+
+
+DOCS = [
+    '<a></a>',
+    '<a x="1">t<b y="2" z="3">u</b><c></c>v<b>w</b></a>',
+    '<a>café €<b k="ü&amp;&lt;">\U0001f600</b>x</a>',
+    #Varints of more than one byte: long text and attribute values, and many names
+    '<a v="{0}">{1}<b>{1}</b></a>'.format('q' * 300, 'r' * 20000),
+    '<a>' + ''.join('<e{0} a{0}="{0}">{0}</e{0}>'.format(i) for i in range(200)) + '</a>',
+]
+
+
+def roundtrip(elem):
+    fp = io.BytesIO()
+    binary.dump(elem, fp)
+    fp.seek(0)
+    return binary.load(fp)
+
+
+@pytest.mark.parametrize('doc', DOCS)
+def test_binary_roundtrip(doc):
+    root = roundtrip(tree.parse(doc))
+    assert type(root) is tree.element
+    assert root.xml_encode() == doc
+    assert root.xml_parent is None
+    stack = [root]
+    while stack:
+        elem = stack.pop()
+        for child in elem.xml_children:
+            assert child.xml_parent is elem
+            if isinstance(child, tree.element): stack.append(child)
+
+
+def test_binary_structure():
+    root = tree.element('a')
+    root.xml_append('1')
+    root.xml_append('2')
+    b = tree.element('b', {'x': 'y'})
+    root.xml_append(b)
+    copy = roundtrip(root)
+    #Adjacent text nodes are kept apart
+    assert copy.xml_children[:2] == ['1', '2']
+    assert all( isinstance(t, tree.text) for t in copy.xml_children[:2] )
+    #Only the subtree is saved
+    copy_b = roundtrip(b)
+    assert copy_b.xml_parent is None and copy_b.xml_encode() == '<b x="y"></b>'
+    assert copy.xml_children[2].xml_children == [] and copy.xml_children[2].xml_attributes == {'x': 'y'}
+    #Loaded trees can be changed as usual
+    copy.xml_children[2].xml_append('z')
+    assert copy.xml_value == '12z'
+
+
+def test_binary_file(tmp_path):
+    doc = DOCS[1]
+    path = tmp_path / 'doc.uxb'
+    with open(path, 'wb') as fp:
+        binary.dump(tree.parse(doc), fp)
+    with open(path, 'rb') as fp:
+        assert binary.load(fp).xml_encode() == doc
+
+
+def test_binary_errors():
+    fp = io.BytesIO()
+    binary.dump(tree.parse(DOCS[1]), fp)
+    data = fp.getvalue()
+    with pytest.raises(ValueError):
+        binary.load(io.BytesIO(b'<a></a>' * 10))
+    with pytest.raises(ValueError):
+        binary.load(io.BytesIO(data[:-3]))
+    with pytest.raises(ValueError):
+        binary.load(io.BytesIO(b''))
+
+
+XPATH_CASES = [
+    (DOCS[1], 'a/b'),
+    (DOCS[1], '//b/@y'),
+    (DOCS[1], 'a/b[.="w"]'),
+    (DOCS[1], '//text()'),
+    (DOCS[1], 'a/b|a/c'),
+    (DOCS[1], 'a/b/..'),
+    (DOCS[1], 'a/b[1]/following-sibling::*'),
+    (DOCS[1], 'a/b[2]/preceding-sibling::node()'),
+    (DOCS[1], 'string(a/b)'),
+    (DOCS[2], '//b/@k'),
+    (DOCS[4], 'count(//*)'),
+    (DOCS[4], '//e150[@a150="150"]/following-sibling::*[1]'),
+]
+
+
+def mapped(doc, tmp_path):
+    path = tmp_path / 'doc.uxb'
+    with open(path, 'wb') as fp:
+        binary.dump(tree.parse(doc), fp)
+    return binary.map_file(str(path))
+
+
+def encoded(results):
+    return [ r.xml_encode() if isinstance(r, tree.node) else r for r in results ]
+
+
+@pytest.mark.parametrize('doc,xpath', XPATH_CASES)
+def test_mapped_xpath(doc, xpath, tmp_path):
+    root = mapped(doc, tmp_path)
+    assert encoded(root.xml_xpath(xpath)) == encoded(tree.parse(doc).xml_xpath(xpath))
+
+
+@pytest.mark.parametrize('doc', DOCS)
+def test_mapped_encode(doc, tmp_path):
+    root = mapped(doc, tmp_path)
+    assert root.xml_encode() == doc
+    assert root.xml_value == tree.parse(doc).xml_value
+
+
+def test_mapped_nav(tmp_path):
+    root = mapped(DOCS[1], tmp_path)
+    assert isinstance(root, tree.element)
+    assert root.xml_name == 'a' and root.xml_attributes == {'x': '1'}
+    assert root.xml_parent is None and root.xml_value == 'tuvw'
+    t, b, c, v, b2 = root.xml_children
+    assert isinstance(t, tree.text) and t == 't' and t.xml_parent == root
+    assert b.xml_attributes == {'y': '2', 'z': '3'} and b.xml_value == 'u'
+    assert c.xml_children == [] and c.xml_attributes is tree.EMPTY_ATTRIBUTES
+    assert b2.xml_value == 'w' and v.xml_parent is root
+    #Proxies for the same element are equal
+    assert b.xml_children[0].xml_parent == b and b.xml_parent == root
+    assert b != b2 and len({b, root.xml_children[1]}) == 1
+    with pytest.raises(TypeError):
+        root.xml_append('x')
+    #Pickles as a plain tree
+    copy = pickle.loads(pickle.dumps(root))
+    assert type(copy) is tree.element and copy.xml_encode() == DOCS[1]
+
+
+def test_mapped_bytes():
+    fp = io.BytesIO()
+    binary.dump(tree.parse(DOCS[2]), fp)
+    root = binary.document(fp.getvalue()).root
+    assert root.xml_children[1].xml_attributes == {'k': 'ü&<'}
+    assert root.xml_children[1].xml_value == '\U0001f600'
+    with pytest.raises(ValueError):
+        binary.document(b'UXB')
@@ -0,0 +1,80 @@
+'''
+py.test test/uxml/test_columnar.py
+'''
+
+import pickle
+
+import pytest
+from amara3.uxml import tree, columnar
+
+
+DOC1 = '<a x="1">t<b y="2" z="3">u</b><c></c>v<b>w</b></a>'
+DOC2 = '<a><b><x>1</x></b><c><x>2</x><d><x>3</x></d></c><x>4</x><y>5</y></a>'
+
+XPATH_CASES = [
+    (DOC1, 'a/b'),
+    (DOC1, '//b/@y'),
+    (DOC1, 'a/b[.="w"]'),
+    (DOC1, '//text()'),
+    (DOC1, 'a/b|a/c'),
+    (DOC1, 'a/b/..'),
+    (DOC1, 'a/b[1]/following-sibling::*'),
+    (DOC1, 'a/b[2]/preceding-sibling::node()'),
+    (DOC1, 'string(a/b)'),
+    (DOC2, '//x'),
+    (DOC2, 'count(//*)'),
+    (DOC2, '//x[.="3"]/../..'),
+]
+
+
+def encoded(results):
+    return [ r.xml_encode() if isinstance(r, tree.node) else r for r in results ]
+
+
+@pytest.mark.parametrize('doc,xpath', XPATH_CASES)
+def test_columnar_xpath(doc, xpath):
+    root = columnar.parse(doc)
+    assert encoded(root.xml_xpath(xpath)) == encoded(tree.parse(doc).xml_xpath(xpath))
+
+
+def test_columnar_nav():
+    root = columnar.parse(DOC1)
+    assert isinstance(root, tree.element)
+    assert root.xml_encode() == DOC1
+    assert root.xml_name == 'a' and root.xml_attributes == {'x': '1'}
+    assert root.xml_parent is None and root.xml_value == 'tuvw'
+    t, b, c, v, b2 = root.xml_children
+    assert isinstance(t, tree.text) and t == 't' and t.xml_parent == root
+    assert b.xml_attributes == {'y': '2', 'z': '3'} and b.xml_value == 'u'
+    assert c.xml_children == [] and c.xml_attributes is tree.EMPTY_ATTRIBUTES
+    #Proxies for the same element are equal
+    assert b.xml_children[0].xml_parent == b and b.xml_parent == root
+    assert b != b2 and len({b, root.xml_children[1]}) == 1
+    with pytest.raises(TypeError):
+        root.xml_append('x')
+
+
+def test_columnar_text_merged():
+    #Text split across fragments makes one node
+    st = columnar.store()
+    from amara3.uxml.parser import parser
+    p = parser(st._handler())
+    p.send(('<a>12', False))
+    p.send(('34</a>', True))
+    st._finish()
+    assert st.root.xml_children == ['1234']
+
+
+def test_columnar_pickle():
+    #Pickles as a plain tree
+    copy = pickle.loads(pickle.dumps(columnar.parse(DOC1)))
+    assert type(copy) is tree.element
+    assert copy.xml_encode() == DOC1
+
+
+def test_columnar_sources(tmp_path):
+    path = tmp_path / 'doc.uxml'
+    path.write_bytes(DOC2.encode('utf-8'))
+    assert columnar.parse_file(str(path)).xml_encode() == DOC2
+    root = columnar.parse_xml('<a xmlns="urn:x" p="q"><b>1</b>2</a>')
+    assert root.xml_encode() == '<a p="q"><b>1</b>2</a>'
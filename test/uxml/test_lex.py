@@ -0,0 +1,81 @@
+import threading
+
+import pytest #Consider also installing pytest_capturelog
+from amara3.uxml import lex, coax
+
+
+def toks(s):
+    return [ (t.type, t.value, t.lexpos) for t in lex.run(s) ]
+
+
+#Expected tokens as given by the earlier PLY lexer, except that space between attributes is
+#now skipped silently and '/>' gives EMPTY_GT rather than an illegal character and GT
+LEX_CASES = [
+    ('<a>x</a>', [('STARTTAG', 'a', 0), ('GT', '>', 2), ('CHARDATA', 'x', 3), ('ENDTAG', 'a', 4)]),
+    ('< a >x</ a >', [('STARTTAG', 'a', 0), ('GT', '>', 4), ('CHARDATA', 'x', 5), ('ENDTAG', 'a', 6)]),
+    ('<a x="1">', [('STARTTAG', 'a', 0), ('NAME', 'x', 3), ('EQ', '=', 4), ('DBL_QUOTE', '"', 5),
+        ('CHARDATA', '1', 6), ('DBL_QUOTE', '"', 7), ('GT', '>', 8)]),
+    ("<a x=''>", [('STARTTAG', 'a', 0), ('NAME', 'x', 3), ('EQ', '=', 4), ('SGL_QUOTE', "'", 5),
+        ('SGL_QUOTE', "'", 6), ('GT', '>', 7)]),
+    ('<a x="1" y=\'&lt;\'>', [('STARTTAG', 'a', 0), ('NAME', 'x', 3), ('EQ', '=', 4), ('DBL_QUOTE', '"', 5),
+        ('CHARDATA', '1', 6), ('DBL_QUOTE', '"', 7), ('NAME', 'y', 9), ('EQ', '=', 10), ('SGL_QUOTE', "'", 11),
+        ('LT_ENT', '&lt;', 12), ('SGL_QUOTE', "'", 16), ('GT', '>', 17)]),
+    ('t&amp;u&#x41;&gt;<!--c-->', [('CHARDATA', 't', 0), ('AMP_ENT', '&amp;', 1), ('CHARDATA', 'u', 6),
+        ('NUM_ENT', '41', 7), ('GT_ENT', '&gt;', 13), ('COMMENT', 'c', 17)]),
+    ('<a/>', [('STARTTAG', 'a', 0), ('EMPTY_GT', '/>', 2)]),
+    ('a>b', [('CHARDATA', 'a', 0), ('GT', '>', 1), ('CHARDATA', 'b', 2)]),
+    ('a\r\nb\rc', [('CHARDATA', 'a\nb\nc', 0)]),
+]
+
+
+@pytest.mark.parametrize('doc,expected', LEX_CASES)
+def test_lex_tokens(doc, expected):
+    assert toks(doc) == expected
+
+
+def test_lex_illegal(capsys):
+    assert toks('a\x01b') == [('CHARDATA', 'a', 0), ('CHARDATA', 'b', 2)]
+    assert "Illegal character ''\\x01''" in capsys.readouterr().err
+
+
+def test_lex_reentrant():
+    #Interleaved tokenizations don't disturb each other
+    doc1, doc2 = '<a x="1">1</a>', '<b>2<c/></b>'
+    t1, t2 = lex.run(doc1), lex.run(doc2)
+    interleaved = [ (next(t1), next(t2)) for i in range(3) ]
+    assert [ t.type for t, u in interleaved ] == ['STARTTAG', 'NAME', 'EQ']
+    assert [ u.type for t, u in interleaved ] == ['STARTTAG', 'GT', 'CHARDATA']
+    assert [ t.type for t in t1 ] == ['DBL_QUOTE', 'CHARDATA', 'DBL_QUOTE', 'GT', 'CHARDATA', 'ENDTAG']
+
+    results = {}
+    def worker(i):
+        results[i] = toks(doc1 * 100)
+    threads = [ threading.Thread(target=worker, args=(i,)) for i in range(4) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert all( r == toks(doc1 * 100) for r in results.values() )
+
+
+def test_coax_run():
+    root = coax.run('<a x="1&amp;2" y=\'q\'>hi &lt; <!--c-->there<b/>&#x41;<c>t</c></a>')
+    assert root.xml_name == 'a'
+    assert root.xml_attributes == {'x': '1&2', 'y': 'q'}
+    assert root.xml_encode() == '<a x="1&amp;2" y="q">hi &lt; there<b></b>A<c>t</c></a>'
+    assert root.xml_children[1].xml_parent is root
+
+
+def test_coax_parse():
+    events = []
+    def sink():
+        while True:
+            events.append((yield))
+    s = sink()
+    next(s)
+    coax.parse('<a k="v">x<b/></a>', s)
+    assert events == [
+        (coax.START_ELEMENT, 'a', {'k': 'v'}),
+        (coax.TEXT, 'x'),
+        (coax.START_ELEMENT, 'b', {}),
+        (coax.END_ELEMENT, 'b'),
+        (coax.END_ELEMENT, 'a'),
+    ]
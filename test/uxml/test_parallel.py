@@ -0,0 +1,38 @@
+'''
+py.test test/uxml/test_parallel.py
+'''
+
+import pytest
+from amara3.uxml import tree, parallel
+
+
+RECORD = '<record id="{0}">\n  <name>N&amp;{0}</name>\n  <note x="a>b">é</note>\n</record>'
+DOC = '<db created="2024">\n' + '\n'.join(RECORD.format(i) for i in range(200)) + '\n</db>\n'
+
+
+@pytest.mark.parametrize('chunksize', [1, 500, 1<<24])
+def test_parse(chunksize):
+    root = parallel.parse(DOC.encode('utf-8'), workers=2, chunksize=chunksize)
+    assert root.xml_encode() == tree.parse(DOC).xml_encode()
+    assert all(child.xml_parent is root for child in root.xml_children)
+
+
+def test_parse_records(tmp_path):
+    path = tmp_path / 'db.uxml'
+    path.write_bytes(DOC.encode('utf-8'))
+    records = list(parallel.parse_records(str(path), workers=2, chunksize=500))
+    assert [ rec.xml_attributes['id'] for rec in records ] == [ str(i) for i in range(200) ]
+    assert records[7].xml_encode() == tree.parse(RECORD.format(7)).xml_encode()
+    assert records[7].xml_parent is None
+    assert records[7].xml_children[1].xml_parent is records[7]
+
+
+def test_nested_records():
+    doc = '<db>' + '<record><record>1</record></record>' * 20 + '</db>'
+    with pytest.raises(ValueError):
+        list(parallel.parse_records(doc.encode('utf-8'), workers=2, chunksize=1))
+
+
+def test_utf16():
+    with pytest.raises(ValueError):
+        parallel.parse(DOC.encode('utf-16'))
@@ -1,6 +1,9 @@
 import pytest
 
-from amara3.uxml.parser import parse, parser, parsefrags, event
+import io
+
+from amara3.uxml.parser import parse, parser, parsefrags, iterparse, event, sniff_encoding, ancestry, SKIP
+from amara3.uxml.parser import rawtext, decode_cdata, ATTRIBVAL_SGL_DECODE, parse_file, handler, checkpoint
 
 
 TEST_PATTERN1 = []
@@ -87,6 +90,33 @@ DOC6_FRAGS[0].append([ c for c in DOC6_FRAGS[0][0] ])
 
 TEST_PATTERN1.append(DOC6_FRAGS)
 
+#Attribute values and character references split across fragments
+DOC7_FRAGS = ([
+    ('<spam x=\'&lt;y&#x3E;\'>eg&amp;gs</spam>',),
+    ('<spam x=\'', '&lt;y&#x3E;\'>eg&amp;gs</spam>',),
+    ('<spam x=\'', '&lt;y', '&#x3E;\'>eg&amp;gs</spam>',),
+    ('<spam x=\'&l', 't;y&#x3E;\'>eg&amp;gs</spam>',),
+    ('<spam x=\'&lt;y&#', 'x3E;\'>eg&amp;gs</spam>',),
+    ('<spam x=\'&lt;y&#x3E;\'>e', 'g&am', 'p;g', 's</spam>',),
+    ('<spam x=\'&lt;y&#x3E;\'>eg&', 'amp;gs<', '/spam>',),
+],
+[(event.start_element, 'spam', {'x': '<y>'}, []), (event.characters, 'eg&gs'), (event.end_element, 'spam', [])])
+
+DOC7_FRAGS[0].append([ c for c in DOC7_FRAGS[0][0][0] ])
+
+TEST_PATTERN1.append(DOC7_FRAGS)
+
+#Long runs of text split across many fragments
+LONG_TEXT = 'eggs & spam ' * 1000
+DOC8 = '<spam>' + LONG_TEXT.replace('&', '&amp;') + '</spam>'
+DOC8_FRAGS = ([
+    [ DOC8[i:i+7] for i in range(0, len(DOC8), 7) ],
+    [ DOC8[i:i+1000] for i in range(0, len(DOC8), 1000) ],
+],
+[(event.start_element, 'spam', {}, []), (event.characters, LONG_TEXT), (event.end_element, 'spam', [])])
+
+TEST_PATTERN1.append(DOC8_FRAGS)
+
 
 INCOMPLETE_DOC1 = [
     ('<spam>',),
@@ -123,3 +153,325 @@ def test_feed_frags1(docfrag, events):
     p.close()
     h.close()
     assert acc == events
+
+
+BYTES_DOC = '<spam x=\'\u00e9t\u00e9\'>\u2603 &amp; \U0001F40D</spam>'
+BYTES_EVENTS = [(event.start_element, 'spam', {'x': '\u00e9t\u00e9'}, []), (event.characters, '\u2603 & \U0001F40D'), (event.end_element, 'spam', [])]
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'utf-8-sig', 'utf-16', 'utf-16-le', 'utf-16-be', 'utf-32'])
+def test_feed_bytes(encoding):
+    encoded = BYTES_DOC.encode(encoding)
+    #Whole, byte by byte (splitting multi-byte sequences) and as memoryview slices
+    assert list(parse(encoded)) == BYTES_EVENTS
+    assert list(parsefrags([ encoded[i:i+1] for i in range(len(encoded)) ])) == BYTES_EVENTS
+    view = memoryview(encoded)
+    assert list(parsefrags([ view[i:i+5] for i in range(0, len(encoded), 5) ])) == BYTES_EVENTS
+
+
+def test_sniff_encoding():
+    assert sniff_encoding(b'<spam>') == 'utf-8'
+    assert sniff_encoding(b'\xef\xbb\xbf<spam>') == 'utf-8-sig'
+    assert sniff_encoding('<spam>'.encode('utf-16-le')) == 'utf-16-le'
+    assert sniff_encoding('<spam>'.encode('utf-32-be')) == 'utf-32-be'
+    with pytest.raises(RuntimeError):
+        sniff_encoding(b'\xfe\xff\x00\x00')
+
+
+LATIN1_DOC = '<spam x=\'\u00e9t\u00e9\'>\u00bfeggs?</spam>'
+LATIN1_EVENTS = [(event.start_element, 'spam', {'x': '\u00e9t\u00e9'}, []), (event.characters, '\u00bfeggs?'), (event.end_element, 'spam', [])]
+
+def test_explicit_encoding():
+    encoded = LATIN1_DOC.encode('latin-1')
+    #Explicit encoding overrides sniffing (which would pick UTF-8 and fail)
+    assert list(parse(encoded, encoding='latin-1')) == LATIN1_EVENTS
+    #Short leading fragments need not be held back when the encoding is given
+    assert list(parsefrags([ encoded[i:i+1] for i in range(len(encoded)) ], encoding='latin-1')) == LATIN1_EVENTS
+    with pytest.raises(RuntimeError):
+        list(parse(encoded))
+
+
+def test_truncated_bytes():
+    #Input ends partway through a multi-byte sequence
+    with pytest.raises(RuntimeError):
+        list(parsefrags([BYTES_DOC.encode('utf-8'), b'\xe2\x98']))
+
+
+def test_no_spurious_events():
+    #The module-level handler is primed only once, so no leading None event
+    assert list(parse('<spam>eggs</spam>')) == DOC1_FRAGS[1]
+    assert list(parsefrags(['<spam>eg', 'gs</spam>'])) == DOC1_FRAGS[1]
+
+
+def _feed_scanned(doc, monkeypatch, fragsize=16):
+    #Feed doc a fragment at a time, returning the events, the largest window handed to handle_cdata,
+    #and the total of the text it was given to scan, from the position it started at
+    from amara3.uxml import parser as parser_module
+    acc = []
+    stats = {'max_window': 0, 'scanned': 0}
+    real_handle_cdata = parser_module.handle_cdata
+    def counting_handle_cdata(pos, window, *args, **kwargs):
+        stats['max_window'] = max(stats['max_window'], len(window))
+        stats['scanned'] += len(window) - pos
+        return real_handle_cdata(pos, window, *args, **kwargs)
+    monkeypatch.setattr(parser_module, 'handle_cdata', counting_handle_cdata)
+    p = parser(handler(acc))
+    for i in range(0, len(doc), fragsize):
+        p.send((doc[i:i+fragsize], False))
+    p.send(('', True))
+    return acc, stats
+
+
+@pytest.mark.parametrize('template', ['<r a="{0}"></r>', '<r>{0}</r>'])
+def test_long_split_values_scale_linearly(template, monkeypatch):
+    for count in (2000, 20000):
+        doc = template.format('x&amp;' * count)
+        acc, stats = _feed_scanned(doc, monkeypatch)
+        assert ''.join(acc[0][2].values()) + (acc[1][1] if len(acc) > 2 else '') == 'x&' * count
+        #The window holds no more than a fragment and the token split across it, however long the value,
+        #and no text is scanned more than about twice. Rescanning from the start would make it quadratic
+        assert stats['max_window'] <= 64
+        assert stats['scanned'] <= 2 * len(doc)
+
+
+@pytest.mark.parametrize('doc', ['<a>xyz', '<a b="xyz', '<a></a', '<a>', '<a', '<a b=', '  ', ''])
+def test_incomplete_doc(doc):
+    with pytest.raises(RuntimeError):
+        list(parse(doc))
+
+
+@pytest.mark.parametrize('frags', [('<a>', '</a'), ('<a>',), ('<a', ' b="1"'), (' ', ' ')])
+def test_incomplete_doc_frags(frags):
+    with pytest.raises(RuntimeError):
+        list(parsefrags(frags))
+
+
+def test_iterparse_sources():
+    doc, expected = DOC3_FRAGS[0][0][0], DOC3_FRAGS[1]
+    assert list(iterparse(doc)) == expected
+    assert list(iterparse(doc.encode('utf-8'))) == expected
+    assert list(iterparse(io.StringIO(doc), chunksize=3)) == expected
+    assert list(iterparse(io.BytesIO(doc.encode('utf-16')), chunksize=3)) == expected
+    assert list(iterparse(iter(DOC3_FRAGS[0][1]))) == expected
+
+
+def test_iterparse_streams():
+    #Events come out chunk by chunk, before the rest of the document is read
+    count = 100000
+    doc = '<a>' + '<b>x</b>' * count + '</a>'
+    stream = io.StringIO(doc)
+    events = iterparse(stream, chunksize=1024)
+    assert next(events) == (event.start_element, 'a', {}, [])
+    assert next(events) == (event.start_element, 'b', {}, ['a'])
+    assert stream.tell() < len(doc) // 10
+    #The rest of the b elements, plus the end of a
+    assert sum(1 for ev in events) == count * 3
+
+
+def skipping_handler(accumulator, skipped):
+    result = None
+    while True:
+        ev = yield result
+        accumulator.append(ev)
+        result = SKIP if ev[0] == event.start_element and ev[1] in skipped else None
+
+
+SKIP_DOC = '<a><b x="&gt;">1<c>2</c>< c >3</ c>< /b><d>4</d></a>'
+SKIP_EVENTS = [
+    (event.start_element, 'a', {}, []),
+    (event.start_element, 'b', {'x': '>'}, ['a']),
+    (event.end_element, 'b', ['a']),
+    (event.start_element, 'd', {}, ['a']),
+    (event.characters, '4'),
+    (event.end_element, 'd', ['a']),
+    (event.end_element, 'a', []),
+]
+
+
+@pytest.mark.parametrize('frags', [(SKIP_DOC,), tuple(SKIP_DOC)])
+def test_skip_subtree(frags):
+    events = []
+    p = parser(skipping_handler(events, {'b'}))
+    for i, frag in enumerate(frags):
+        p.send((frag, i == len(frags) - 1))
+    assert events == SKIP_EVENTS
+
+
+def test_skip_subtree_incomplete():
+    with pytest.raises(RuntimeError):
+        parser(skipping_handler([], {'b'})).send(('<a><b><c></c>', True))
+
+
+LAZY_DOC = '<a x="1&amp;2" y=\'&#x41;&apos;"\'>x&lt;y&gt;&#x20AC;\x01z<b>plain</b></a>'
+
+@pytest.mark.parametrize('frags', [(LAZY_DOC,), tuple(LAZY_DOC)])
+def test_lazy_mode(frags):
+    lazy = list(iterparse(frags, lazy=True))
+    assert lazy == list(parse(LAZY_DOC))
+    attrs = lazy[0][2]
+    assert all(isinstance(v, rawtext) for v in attrs.values())
+    assert attrs['x'].raw == '1&amp;2' and attrs['x'].has_refs
+    assert str(attrs['y']) == 'A\'"'
+    assert lazy[1][1].raw == 'x&lt;y&gt;&#x20AC;\x01z' and lazy[1][1].value == 'x<y>\u20acz'
+    assert lazy[3][1].raw == 'plain' and not lazy[3][1].has_refs
+
+
+def test_lazy_errors_deferred():
+    #Bad references only raise once the value is asked for
+    events = list(iterparse('<a x="&bogus;">&#xD800;</a>', lazy=True))
+    with pytest.raises(RuntimeError):
+        events[0][2]['x'].value
+    with pytest.raises(RuntimeError):
+        str(events[1][1])
+
+
+@pytest.mark.parametrize('raw', ['&amp', '&#x;', '&nbsp;', '&#65;'])
+def test_decode_cdata_errors(raw):
+    with pytest.raises(RuntimeError):
+        decode_cdata(raw)
+
+
+def test_decode_cdata():
+    assert decode_cdata('&lt;&gt;&amp;&quot;&apos;&#x3c;') == '<>&"\'<'
+    assert decode_cdata('a\x01b>c') == 'abc'
+    #As with handle_cdata, '>' is among the characters skipped in attribute values
+    assert decode_cdata('a>"b', ATTRIBVAL_SGL_DECODE) == 'a"b'
+
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'utf-16'])
+def test_parse_file(tmp_path, encoding):
+    doc = '<a x="é">€' + DOC3_FRAGS[0][0][0] + '</a>'
+    path = tmp_path / 'doc.uxml'
+    path.write_bytes(doc.encode(encoding))
+    #Tiny chunks, so that multi-byte characters are split between them
+    assert list(parse_file(str(path), chunksize=3)) == list(parse(doc))
+    assert list(parse_file(str(path))) == list(parse(doc))
+
+
+def test_parse_file_empty(tmp_path):
+    path = tmp_path / 'empty.uxml'
+    path.write_bytes(b'')
+    with pytest.raises(RuntimeError):
+        list(parse_file(str(path)))
+
+
+CP_DOC = '<a x="1">t€xt<b>é</b>  more<c><d>z</d></c></a>'
+
+@pytest.mark.parametrize('encoding', [None, 'utf-8', 'utf-16', 'utf-16-be', 'utf-8-sig'])
+def test_checkpoint_resume(encoding):
+    data = CP_DOC if encoding is None else CP_DOC.encode(encoding)
+    expected = list(parse(CP_DOC))
+    events = []
+    p = parser(handler(events), checkpoints=True)
+    for i in range(0, len(data), 3):
+        cp = p.send((data[i:i+3], False))
+        if cp is None: continue
+        assert isinstance(cp, checkpoint)
+        #Every event up to the checkpoint has been sent, and resuming from it gives the rest
+        resumed = []
+        rest = data[cp.offset:] if encoding is None else data[cp.byte_offset:]
+        parser(handler(resumed), resume=cp).send((rest, True))
+        assert events + resumed == expected
+    p.send((data[:0], True))
+
+
+def test_checkpoint_resume_file(tmp_path):
+    path = tmp_path / 'doc.uxml'
+    doc = '<db>' + ''.join('<r n="{0}">é{0}</r>'.format(i) for i in range(1000)) + '</db>'
+    path.write_bytes(doc.encode('utf-8'))
+    events, saved = [], []
+    def on_checkpoint(cp):
+        saved.append((cp, len(events)))
+    for ev in parse_file(str(path), chunksize=1000, on_checkpoint=on_checkpoint):
+        events.append(ev)
+        if len(events) == 1500: break #As if the process died
+    cp, count = saved[-1]
+    assert 0 < cp.byte_offset < len(doc.encode('utf-8'))
+    assert cp.elements[0] == 'db'
+    resumed = list(parse_file(str(path), chunksize=1000, resume=cp))
+    assert events[:count] + resumed == list(parse(doc))
+
+
+MULTIDOC_EVENTS = [
+    (event.start_element, 'a', {'x': '1'}, []),
+    (event.characters, 'y'),
+    (event.end_element, 'a', []),
+    (event.end_document,),
+    (event.start_element, 'b', {}, []),
+    (event.end_element, 'b', []),
+    (event.end_document,),
+    (event.start_element, 'a', {}, []),
+    (event.end_element, 'a', []),
+    (event.end_document,),
+]
+
+@pytest.mark.parametrize('stream', ['<a x="1">y</a><b></b><a></a>', ' <a x="1">y</a>\n<b></b>\n\n<a></a>\n'])
+def test_multidoc(stream):
+    assert list(iterparse(stream, multidoc=True)) == MULTIDOC_EVENTS
+    assert list(iterparse(iter(stream), multidoc=True)) == MULTIDOC_EVENTS
+    #Without multidoc, the second document is junk
+    with pytest.raises(RuntimeError):
+        list(parse(stream))
+
+
+@pytest.mark.parametrize('stream', ['', '  '])
+def test_multidoc_empty(stream):
+    assert list(iterparse(stream, multidoc=True)) == []
+
+
+@pytest.mark.parametrize('stream', ['<a></a><b>', '<a></a>junk<b></b>'])
+def test_multidoc_errors(stream):
+    with pytest.raises(RuntimeError):
+        list(iterparse(stream, multidoc=True))
+
+
+def test_junk_before_document():
+    with pytest.raises(RuntimeError):
+        list(parse('x<a></a>'))
+
+
+def test_disallowed_chars_skipped():
+    #Characters not allowed in content are dropped, whether within one run or split across fragments
+    expected = [(event.start_element, 'a', {}, []), (event.characters, 'xy'), (event.end_element, 'a', [])]
+    assert list(parse('<a>x\x01y</a>')) == expected
+    assert list(parsefrags(['<a>x', '\x01', 'y</a>'])) == expected
+
+
+def test_batch_mode():
+    sends = []
+    p = parser(handler(sends), batch=True)
+    frags = DOC3_FRAGS[0][1]
+    for i, frag in enumerate(frags):
+        p.send((frag, i == len(frags) - 1))
+    #One list per fragment that produced any events
+    assert all(isinstance(batch, list) for batch in sends)
+    assert len(sends) <= len(frags)
+    assert [ ev for batch in sends for ev in batch ] == DOC3_FRAGS[1]
+
+
+def test_shared_ancestry():
+    depth = 500
+    doc = ''.join( '<e{0}>'.format(i) for i in range(depth) ) + ''.join( '</e{0}>'.format(i) for i in reversed(range(depth)) )
+    events = list(parse(doc))
+    starts = [ ev for ev in events if ev[0] == event.start_element ]
+    #Each start element's ancestry extends the previous one's, rather than copying it
+    for prev, curr in zip(starts, starts[1:]):
+        assert curr[3].parent is prev[3]
+        assert curr[3].name == prev[1]
+    assert starts[-1][3] == [ 'e{0}'.format(i) for i in range(depth - 1) ]
+    #End elements get the ancestry the matching start element had
+    assert events[-2][2] is starts[1][3]
+    assert isinstance(events[-1][2], ancestry) and events[-1][2] == []
+
+
+def test_close_mismatch():
+    with pytest.raises(RuntimeError):
+        list(parse('<a></b>'))
+
+
+def test_int_opcodes():
+    from amara3.uxml.parser import START_ELEMENT, END_ELEMENT, CHARACTERS
+    events = list(parse('<spam>eggs</spam>'))
+    #Enum members are the opcodes, and compare equal to plain ints
+    assert [ ev[0] for ev in events ] == [START_ELEMENT, CHARACTERS, END_ELEMENT] == [1, 3, 2]
+    assert events[0][0] is event.start_element
+    assert events == [(1, 'spam', {}, []), (3, 'eggs'), (2, 'spam', [])]
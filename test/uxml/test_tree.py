@@ -2,7 +2,8 @@
 py.test test/uxml/test_tree.py
 '''
 
-# import sys
+import sys
+import pickle
 # import logging
 
 import pytest  # Consider also installing pytest_capturelog
@@ -61,5 +62,282 @@ def test_add_remove():
     #FIXME: More testing
 
 
+def test_interned_names():
+    from amara3.uxml import xml
+    doc = '<a><b x="1">1</b><b x="2">2</b><b x="3">3</b></a>'
+    for root in (tree.parse(doc), xml.treebuilder().parse(doc)):
+        b1, b2, b3 = root.xml_children
+        #Same name, same string object
+        assert b1.xml_name is b2.xml_name is b3.xml_name
+        assert list(b1.xml_attributes)[0] is list(b3.xml_attributes)[0]
+
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'utf-16'])
+def test_parse_file(tmp_path, encoding):
+    path = tmp_path / 'doc.uxml'
+    path.write_bytes(('<a x="é">€' + DOC3 + '</a>').encode(encoding))
+    root = tree.parse_file(str(path))
+    assert root.xml_encode() == tree.parse('<a x="é">€' + DOC3 + '</a>').xml_encode()
+
+
+def test_pickle():
+    root = tree.parse('<a x="1">t<b y="2">u</b></a>')
+    for node in (root, root.xml_children[1]):
+        copy = pickle.loads(pickle.dumps(node))
+        assert copy.xml_encode() == node.xml_encode()
+        #The copy is the root of its own tree
+        assert copy.xml_parent is None
+        assert all(child.xml_parent is copy for child in copy.xml_children)
+    copy = pickle.loads(pickle.dumps(root.xml_children[0]))
+    assert isinstance(copy, tree.text) and copy == 't' and copy.xml_parent is None
+
+
+def test_compact_nodes():
+    root = tree.parse('<a><b></b><c x="1"></c></a>')
+    b, c = root.xml_children
+    assert not hasattr(root, '__dict__')
+    #Elements without attributes share one read-only mapping
+    assert root.xml_attributes is b.xml_attributes is tree.EMPTY_ATTRIBUTES
+    with pytest.raises(TypeError):
+        b.xml_attributes['x'] = '1'
+    assert c.xml_attributes == {'x': '1'}
+    #A dict passed in is kept, even if empty, to be filled in later
+    attrs = {}
+    d = element('d', attrs)
+    d.xml_attributes['y'] = '2'
+    assert d.xml_attributes is attrs and d.xml_encode() == '<d y="2"></d>'
+    assert element('d').xml_attributes is tree.EMPTY_ATTRIBUTES
+    #No children list until one is needed
+    assert b._xml_children is None
+    assert b.xml_value == '' and b.xml_encode() == '<b></b>'
+    assert b._xml_children is None
+    b.xml_append('t')
+    assert b.xml_children == ['t'] and b.xml_children[0].xml_parent is b
+    b.xml_children = []
+    assert b.xml_encode() == '<b></b>'
+
+    copy = pickle.loads(pickle.dumps(root))
+    assert copy.xml_encode() == root.xml_encode()
+    assert copy.xml_attributes is tree.EMPTY_ATTRIBUTES
+
+    #Subclasses may add attributes of their own, which are pickled too
+    e = extended_element('e')
+    e.extra = 1
+    copy = pickle.loads(pickle.dumps(e))
+    assert copy.extra == 1
+
+
+class extended_element(element):
+    pass
+
+
+class cached_element(element):
+    xml_cache_value = True
+
+
+def test_cached_value():
+    a = cached_element('a')
+    b = cached_element('b', parent=a)
+    a.xml_append(b)
+    b.xml_append('1')
+    a.xml_append('2')
+    assert a.xml_value == '12' and b.xml_value == '1'
+    assert a._xml_value_cache == '12'
+    #Changes below clear the caches up the ancestor chain
+    b.xml_insert('0', 0)
+    assert a.xml_value == '012' and b.xml_value == '01'
+    b.xml_remove(b.xml_children[1])
+    assert a.xml_value == '02'
+    b.xml_children = [tree.text('x', b)]
+    assert a.xml_value == 'x2'
+    assert list(a.xml_xpath('a/b[.="x"]')) == [b]
+    #Uncached by default
+    e = tree.parse('<a><b>1</b></a>')
+    assert e.xml_value == '1' and e._xml_value_cache is None
+    #Nor is the ancestor chain walked on changes, without caching or a docindex
+    class counted(element):
+        __slots__ = ()
+        walks = 0
+        def _xml_invalidate(self):
+            counted.walks += 1
+            return element._xml_invalidate(self)
+    top = counted('a')
+    top.xml_append(counted('b'))
+    top.xml_children[0].xml_append('1')
+    top.xml_children[0].xml_remove(top.xml_children[0].xml_children[0])
+    assert counted.walks == 0
+
+
+def test_xml_write(tmp_path):
+    import io
+    doc = '<a x="1&amp;">t&lt;<b y="2"><c></c>u</b>v<d><e><f>é€</f></e></d></a>'
+    root = tree.parse(doc)
+    for indent in (None, '  '):
+        expected = root.xml_encode(indent=indent)
+        fp = io.StringIO()
+        root.xml_write(fp, indent=indent, bufsize=5)
+        assert fp.getvalue() == expected
+    fp = io.BytesIO()
+    root.xml_write(fp)
+    assert fp.getvalue().decode('utf-8') == doc
+    #Characters the encoding lacks become character references
+    path = tmp_path / 'out.uxml'
+    with open(path, 'wb') as fp:
+        root.xml_write(fp, encoding='latin-1')
+    assert path.read_bytes().endswith('<f>é&#x20AC;</f></e></d></a>'.encode('latin-1'))
+    assert tree.parse(path.read_bytes().decode('latin-1')).xml_encode() == doc
+    #A subclass's own serialization is used, as by xml_encode
+    class shouting(element):
+        __slots__ = ()
+        def xml_encode(self, indent=None, depth=0):
+            return element.xml_encode(self, indent, depth).upper()
+    loud = shouting('a')
+    loud.xml_append('hi')
+    fp = io.StringIO()
+    loud.xml_write(fp)
+    assert fp.getvalue() == '<A>HI</A>'
+
+
+def test_xml_write_deep():
+    import io
+    root = elem = element('a')
+    for i in range(sys.getrecursionlimit() * 2):
+        child = element('a', parent=elem)
+        elem.xml_children.append(child)
+        elem = child
+    fp = io.StringIO()
+    root.xml_write(fp)
+    depth = sys.getrecursionlimit() * 2 + 1
+    assert fp.getvalue() == '<a>' * depth + '</a>' * depth
+    assert root.xml_encode() == fp.getvalue()
+
+
+def test_docindex():
+    root = tree.parse('<a><b id="1">x</b><c><b id="2">y</b></c></a>', index=True)
+    idx = tree.docindex.get(root.xml_children[1])
+    assert idx is not None
+    assert [ e.xml_value for e in idx.elements('b') ] == ['x', 'y']
+    assert [ e.xml_value for e in idx.attribute('id') ] == ['x', 'y']
+    assert [ e.xml_value for e in idx.attribute('id', '2') ] == ['y']
+    assert idx.elements('nope') == [] and idx.attribute('id', '3') == []
+    #Insertions are put in document order
+    c = root.xml_children[1]
+    new = tree.element('b', {'id': '3'})
+    new.xml_append('z')
+    c.xml_insert(new, 0)
+    assert [ e.xml_value for e in idx.elements('b') ] == ['x', 'z', 'y']
+    assert idx.attribute('id', '3') == [new]
+    #Removed subtrees are dropped, and become roots without an index
+    root.xml_remove(c)
+    assert [ e.xml_value for e in idx.elements('b') ] == ['x']
+    assert idx.elements('c') == [] and idx.attribute('id', '3') == []
+    assert tree.docindex.get(new) is None
+    root.xml_children = [c]
+    assert [ e.xml_value for e in idx.elements('b') ] == ['z', 'y']
+    assert tree.docindex.get(tree.parse('<a></a>')) is None
+
+
+def test_docorder_labels():
+    import random
+    random.seed(0)
+    root = tree.parse('<a><b>1</b><c><d>2</d></c></a>')
+    b, c = root.xml_children
+    assert tree.compare_docorder(b, c) == -1 and tree.compare_docorder(c.xml_children[0], b) == 1
+    assert tree.compare_docorder(b, b) == 0
+    #Insertions keep all labels in document order, relabeling as needed
+    elems = [root, b, c]
+    for i in range(2000):
+        parent = random.choice(elems)
+        new = element('e')
+        if i % 3 == 0: new.xml_append('t')
+        parent.xml_insert(new, random.randint(0, len(parent.xml_children)))
+        elems.append(new)
+    nodes = []
+    def walk(node):
+        nodes.append(node)
+        for child in node.xml_children: walk(child)
+    walk(root)
+    labels = [ n._docorder for n in nodes ]
+    assert labels == sorted(labels) and len(set(labels)) == len(labels)
+    assert all( tree.compare_docorder(x, y) == -1 for x, y in zip(nodes, nodes[1:]) )
+
+
+def test_docorder_move():
+    #Nodes moved out of a labeled document are compared by their place in the new one
+    d1 = tree.parse('<a><b>1</b><c>2</c></a>')
+    b, c = d1.xml_children
+    assert tree.compare_docorder(b, c) == -1
+    d2 = tree.parse('<x><y></y></x>')
+    d1.xml_remove(c)
+    d2.xml_insert(c, 0)
+    d1.xml_remove(b)
+    d2.xml_insert(b, 1)
+    assert tree.compare_docorder(c, b) == -1
+    assert tree.compare_docorder(b, d2.xml_children[2]) == -1
+    #Removed nodes are labeled afresh as a tree of their own
+    d2.xml_remove(c)
+    assert tree.compare_docorder(c, c.xml_children[0]) == -1
+
+
+LAZY_DOCS = DOC_CASES + [
+    ' <a x="1">t<b y="2" z="3">u<c>1<d>2</d></c></b><c></c>v<b>w&amp;&#x41;</b></a>\n',
+    '<a>é<b k="ü">€</b></a>',
+    #'>' in attribute values, and space within tags, as the parser allows
+    '<a><b x="2>3" y=\'>\'>t</b></a>',
+    '<a\n><b\tz="/" >1</ b\r\n>2</a >\n',
+]
+
+
+def unmaterialized(elem):
+    return elem._xml_source is not None and tree._CHILDREN_SLOT.__get__(elem) is None
+
+
+@pytest.mark.parametrize('doc', LAZY_DOCS)
+def test_lazy_parse(doc, tmp_path):
+    expected = tree.parse(doc).xml_encode()
+    path = tmp_path / 'doc.uxml'
+    path.write_bytes(doc.encode('utf-8'))
+    path16 = tmp_path / 'doc16.uxml'
+    path16.write_bytes(doc.encode('utf-16'))
+    for root in (tree.parse(doc, lazy=True), tree.parse(doc.encode('utf-8'), lazy=True),
+                tree.parse(doc.encode('utf-16'), lazy=True), tree.parse_file(str(path), lazy=True),
+                tree.parse_file(str(path16), lazy=True)):
+        assert isinstance(root, tree.lazy_element) and unmaterialized(root)
+        assert root.xml_encode() == expected
+
+
+def test_lazy_materialize():
+    root = tree.parse(LAZY_DOCS[-4], lazy=True)
+    t, b, c, v, b2 = root.xml_children
+    assert root._xml_source is None
+    #Only the children of elements visited are built
+    assert unmaterialized(b) and unmaterialized(b2)
+    assert c._xml_source is None and c.xml_children == []
+    assert b.xml_attributes == {'y': '2', 'z': '3'} and b.xml_parent is root and t.xml_parent is root
+    assert b2.xml_value == 'w&A' and unmaterialized(b)
+    assert [ e.xml_value for e in root.xml_xpath('a/b/c/d') ] == ['2']
+    #Changes apply to the materialized children
+    b2.xml_append('x')
+    b.xml_insert(element('e'), 0)
+    assert root.xml_encode() == '<a x="1">t<b y="2" z="3"><e></e>u<c>1<d>2</d></c></b><c></c>v<b>w&amp;Ax</b></a>'
+    #Pickles as plain elements
+    other = tree.parse(LAZY_DOCS[-4], lazy=True)
+    copy = pickle.loads(pickle.dumps(other))
+    assert type(copy) is element and copy.xml_encode() == tree.parse(LAZY_DOCS[-4]).xml_encode()
+
+
+def test_lazy_errors():
+    #Errors within an element's content are found once its children are needed
+    root = tree.parse('<a><b>&bogus;</b><c></c></a>', lazy=True)
+    b, c = root.xml_children
+    with pytest.raises(RuntimeError):
+        b.xml_children
+    for doc in ('<a><b></a>', '<a><b></c></a>', '<a></b></a>'):
+        with pytest.raises(RuntimeError):
+            tree.parse(doc, lazy=True).xml_children
+    with pytest.raises(RuntimeError):
+        tree.parse('<a>x</a>junk', lazy=True)
+
+
 if __name__ == '__main__':
     raise SystemExit("Run with py.test")
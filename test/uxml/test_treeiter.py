@@ -56,5 +56,33 @@ def test_ts_basics():
     return
 
 
+def test_ts_multiple_patterns():
+    def sink(accumulator):
+        while True:
+            e = yield
+            accumulator.append(e.xml_value)
+
+    bvalues, xvalues = [], []
+    ts = treeiter.sender([('a', 'b'), ('a', '**', 'x')], [sink(bvalues), sink(xvalues)])
+    ts.parse(DOC4)
+    assert bvalues == ['1']
+    assert xvalues == ['1', '2', '3', '4']
+    return
+
+
+def test_ts_skips_dead_subtrees():
+    #Subtrees which can't match are skipped by the parser, so bad character references in their content go unnoticed
+    def sink(accumulator):
+        while True:
+            e = yield
+            accumulator.append(e.xml_value)
+
+    values = []
+    ts = treeiter.sender(('a', 'b'), sink(values))
+    ts.parse('<a><c><d>&bogus;</d>&bogus;</c><b>1</b><c x="y">&bogus;</c></a>')
+    assert values == ['1']
+    return
+
+
 if __name__ == '__main__':
     raise SystemExit("Run with py.test")
@@ -156,5 +156,52 @@ def test_expressions(path, top, expected):
     assert tresult == expected, (tresult, expected)
 
 
+INDEXED_DOC = '<a><b id="1">x</b><c id="2"><b id="2">y</b><b>z</b></c><d><b id="3"></b></d></a>'
+
+INDEXED_CASES = [
+    '//b',
+    '//c',
+    '//nope',
+    '//@id',
+    '//b[@id="2"]',
+    '//*[@id="2"]',
+    '//@id[.="2"]',
+    '//d[@id="2"]',
+    '//b[@id=2]',
+    '//b[1]',
+]
+
+
+@pytest.mark.parametrize('path', INDEXED_CASES)
+def test_indexed(path):
+    #A docindex gives the same results, in document order
+    def results(root):
+        return [ (r.xml_name, r.xml_value) for r in uxpathparse(path).compute(context(root)) ]
+    plain = results(tree.parse(INDEXED_DOC))
+    root = tree.parse(INDEXED_DOC, index=True)
+    assert results(root) == plain
+    #And after changes
+    root.xml_children[2].xml_insert(tree.element('b', {'id': '2'}), 0)
+    root.xml_remove(root.xml_children[0])
+    changed = tree.parse(INDEXED_DOC)
+    changed.xml_children[2].xml_insert(tree.element('b', {'id': '2'}), 0)
+    changed.xml_remove(changed.xml_children[0])
+    assert results(root) == results(changed)
+
+
+def test_union_docorder():
+    root = tree.parse('<a x="1" y="2"><b>1</b><c><d>2</d></c></a>')
+    result = list(uxpathparse('a/c/d|a/b|a/@y|a/b|a/@x').compute(context(root)))
+    assert [ r.xml_name for r in result ] == ['y', 'x', 'b', 'd']
+    #A repeated attribute, with another attribute of the element sorted between its copies
+    result = list(uxpathparse('a/@x|a/@y|a/@x').compute(context(root)))
+    assert sorted( r.xml_name for r in result ) == ['x', 'y']
+    #Still in order after changes, without relabeling everything
+    root.xml_children[1].xml_insert(tree.element('b'), 0)
+    result = list(uxpathparse('a/c/d|a/c/b|a/b').compute(context(root)))
+    assert [ r.xml_name for r in result ] == ['b', 'b', 'd']
+    assert result[1].xml_parent.xml_name == 'c'
+
+
 if __name__ == '__main__':
     raise SystemExit("Run with py.test")